@@ -1,11 +1,33 @@
 import os
+import re
 import fnmatch
 
-def should_ignore_for_structure(path, ignore_patterns):
-    return any(fnmatch.fnmatch(path, pattern) for pattern in ignore_patterns)
+def compile_patterns(patterns):
+    """
+    Compile a list of glob patterns into a single matcher function.
 
-def should_ignore_for_content(path, ignore_patterns, script_name, output_file):
-    return any(fnmatch.fnmatch(path, pattern) for pattern in ignore_patterns) or \
+    Hidden-file ('.*') and literal name patterns are answered with a prefix
+    check and a set lookup; only the remaining globs go through a regex.
+    """
+    match_hidden = '.*' in patterns
+    literal_names = {p for p in patterns if not any(c in p for c in '*?[')}
+    globs = [p for p in patterns if p != '.*' and p not in literal_names]
+    glob_re = re.compile('|'.join(fnmatch.translate(p) for p in globs)) if globs else None
+
+    def matches(name):
+        if match_hidden and name.startswith('.'):
+            return True
+        if name in literal_names:
+            return True
+        return glob_re is not None and glob_re.match(name) is not None
+
+    return matches
+
+def should_ignore_for_structure(path, ignore_matcher):
+    return ignore_matcher(path)
+
+def should_ignore_for_content(path, ignore_matcher, script_name, output_file):
+    return ignore_matcher(path) or \
            path == script_name or path == output_file
 
 def generate_codebase_txt(root_dir, output_file, script_name):
@@ -40,13 +62,22 @@ def generate_codebase_txt(root_dir, output_file, script_name):
         '.git',  # Git repository folder
     ]
 
-    with open(output_file, 'w', encoding='utf-8') as f:
+    structure_ignore_matcher = compile_patterns(structure_ignore_patterns)
+    content_ignore_matcher = compile_patterns(content_ignore_patterns)
+
+    # Large write buffer: the output is written in many small pieces
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
         f.write("Directory Structure:\n")
         f.write("====================\n\n")
 
+        # Walk the tree once; the content section reuses the files collected here.
+        # Every structure pattern is also a content pattern, so the content pass
+        # only ever sees a subset of the structure walk.
+        content_files = []
+        content_ignored_dirs = set()
         for root, dirs, files in os.walk(root_dir):
-            dirs[:] = [d for d in dirs if not should_ignore_for_structure(d, structure_ignore_patterns)]
-            files = [file for file in files if not should_ignore_for_structure(file, structure_ignore_patterns)]
+            dirs[:] = [d for d in dirs if not should_ignore_for_structure(d, structure_ignore_matcher)]
+            files = [file for file in files if not should_ignore_for_structure(file, structure_ignore_matcher)]
 
             level = root.replace(root_dir, '').count(os.sep)
             indent = ' ' * 4 * level
@@ -55,27 +86,32 @@ def generate_codebase_txt(root_dir, output_file, script_name):
             for file in files:
                 f.write(f'{sub_indent}{file}\n')
 
+            if root in content_ignored_dirs:
+                content_ignored_dirs.update(os.path.join(root, d) for d in dirs)
+                continue
+            for d in dirs:
+                if should_ignore_for_content(d, content_ignore_matcher, script_name, output_file):
+                    content_ignored_dirs.add(os.path.join(root, d))
+            content_files.extend(
+                os.path.join(root, file) for file in files
+                if not should_ignore_for_content(file, content_ignore_matcher, script_name, output_file)
+            )
+
         f.write("\n\nFile Contents:\n")
         f.write("==============\n\n")
 
-        for root, dirs, files in os.walk(root_dir):
-            dirs[:] = [d for d in dirs if not should_ignore_for_content(d, content_ignore_patterns, script_name, output_file)]
-            files = [file for file in files if not should_ignore_for_content(file, content_ignore_patterns, script_name, output_file)]
+        for file_path in content_files:
+            relative_path = os.path.relpath(file_path, root_dir)
+            f.write(f"File: {relative_path}\n")
+            f.write("=" * (len(relative_path) + 6) + "\n\n")
 
-            for file in files:
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, root_dir)
-                f.write(f"File: {relative_path}\n")
-                f.write("=" * (len(relative_path) + 6) + "\n\n")
-                
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as source_file:
-                        content = source_file.read()
-                        f.write(content)
-                except Exception as e:
-                    f.write(f"Error reading file: {str(e)}\n")
-                
-                f.write("\n\n")
+            try:
+                with open(file_path, 'r', encoding='utf-8') as source_file:
+                    f.write(source_file.read())
+            except Exception as e:
+                f.write(f"Error reading file: {str(e)}\n")
+
+            f.write("\n\n")
 
 if __name__ == "__main__":
     current_dir = os.getcwd()
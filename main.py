@@ -29,17 +29,38 @@ def run_script(script_name):
     except Exception as e:
         logging.error(f"Unexpected error running {script_name}: {e}")
 
+def start_script(script_name):
+    script_path = os.path.join(project_root, 'src', 'scripts', script_name)
+    logging.info(f"Starting {script_name}")
+    try:
+        return subprocess.Popen([sys.executable, script_path])
+    except Exception as e:
+        logging.error(f"Unexpected error starting {script_name}: {e}")
+        return None
+
+def wait_script(script_name, process):
+    if process is None:
+        return
+    returncode = process.wait()
+    if returncode == 0:
+        logging.info(f"{script_name} completed successfully")
+    else:
+        logging.error(f"Error running {script_name}: exited with status {returncode}")
+
 def main():
     logging.info(f"Starting main process at {datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()}")
     
     # Run lastfm_spotify_liker.py
     run_script('lastfm_spotify_liker.py')
     
-    # Run album_saver.py
-    run_script('album_saver.py')
-    
-    # Run hot_100_playlist.py
-    run_script('hot_100_playlist.py')
+    # album_saver.py and hot_100_playlist.py only depend on the Last.fm history
+    # updated above and write to separate databases, so run them in parallel. Both
+    # prompt and authorize with Spotify under utils.terminal_lock, so they take turns
+    # at the terminal
+    album_saver = start_script('album_saver.py')
+    hot_100_playlist = start_script('hot_100_playlist.py')
+    wait_script('album_saver.py', album_saver)
+    wait_script('hot_100_playlist.py', hot_100_playlist)
     
     logging.info(f"Main process completed at {datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()}")
 
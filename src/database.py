@@ -2,20 +2,121 @@
 
 import sqlite3
 import logging
+import threading
 from datetime import datetime, timezone
-from src.utils import normalize_string
-from typing import List, Dict, Optional
+from src.utils import normalize_string, normalize_strings
+from typing import List, Dict, Iterable, Optional, Set, Tuple
+
+# Per-connection tuning applied once when a connection is opened.
+# WAL is persisted in the database file; the rest must be re-applied per connection.
+SQLITE_PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-65536',
+    'mmap_size=268435456',
+    'busy_timeout=5000',
+    'wal_autocheckpoint=1000',
+)
+
+# Compiled statements kept per connection; the cache is keyed on the SQL text, so
+# the queries below are shared constants and compile once per long-lived connection
+SQLITE_CACHED_STATEMENTS = 256
+
+SQL_ADD_OR_UPDATE_TRACK = '''
+INSERT INTO tracks (artist, name, album, listen_count, last_listened, last_listened_ts, mbid)
+VALUES (?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT(artist, name) DO UPDATE SET
+listen_count = listen_count + 1,
+last_listened = ?,
+last_listened_ts = ?,
+album = COALESCE(?, album),
+mbid = COALESCE(?, mbid)
+'''
+
+SQL_FREQUENTLY_PLAYED_TRACKS = '''
+SELECT artist, name, listen_count
+FROM tracks
+WHERE listen_count >= ? AND processed = 0
+ORDER BY listen_count DESC
+'''
+
+SQL_MARK_PROCESSED = '''
+UPDATE tracks
+SET processed = 1
+WHERE (artist, name) IN (SELECT artist, name FROM processed_keys)
+'''
+
+def open_connection(db_file: str, query_only: bool = False) -> sqlite3.Connection:
+    """
+    Open a SQLite connection with the standard PRAGMA tuning applied.
+
+    normalize_string is registered as the deterministic SQL function normalize(),
+    so queries can normalize raw columns without pulling the rows into Python.
+    With query_only, SQLite rejects any write made through the connection.
+    """
+    conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=SQLITE_CACHED_STATEMENTS)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    if query_only:
+        conn.execute("PRAGMA query_only=1")
+    conn.create_function('normalize', 1, normalize_string, deterministic=True)
+    return conn
+
+def close_connection(conn: sqlite3.Connection) -> None:
+    """
+    Close a writer connection opened by open_connection.
+
+    PRAGMA optimize first lets SQLite re-analyze any table whose indexes the
+    session's queries would have benefited from fresher statistics for.
+    """
+    conn.execute("PRAGMA optimize")
+    conn.close()
 
 class Database:
     def __init__(self, db_file: str = 'db/lastfm_history.db'):
         """Initialize the Database class."""
         self.db_file = db_file
+        self._conn: Optional[sqlite3.Connection] = None
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
         self.create_table()
         self.add_processed_column()  # Add this line to ensure the 'processed' column exists
+        self.add_last_listened_ts_column()
+        self.create_indexes()
 
     def connect(self) -> sqlite3.Connection:
-        """Connect to the SQLite database."""
-        return sqlite3.connect(self.db_file)
+        """Return the long-lived writer connection to the SQLite database, opening it on first use."""
+        if self._conn is None:
+            self._conn = open_connection(self.db_file)
+        return self._conn
+
+    def read_connection(self) -> sqlite3.Connection:
+        """
+        Return this thread's query-only connection, opening it on first use.
+
+        Under WAL, readers on their own connections see the last committed state
+        and are never blocked by, nor block, a write in progress on connect().
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = open_connection(self.db_file, query_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self) -> None:
+        """Close the writer connection and every reader connection."""
+        if self._conn is not None:
+            close_connection(self._conn)
+            self._conn = None
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self._local = threading.local()
 
     def create_table(self) -> None:
         """Create the tracks table in the database if it doesn't exist."""
@@ -29,6 +130,7 @@ class Database:
                     album TEXT,
                     listen_count INTEGER,
                     last_listened DATETIME,
+                    last_listened_ts INTEGER,
                     mbid TEXT,
                     processed BOOLEAN DEFAULT 0,
                     UNIQUE(artist, name)
@@ -37,102 +139,137 @@ class Database:
             conn.commit()
         logging.info("Initialized tracks table in Last.fm database.")
 
-    def add_or_update_track(self, track: Dict) -> None:
-        """Add a new track or update an existing track in the database."""
-        artist = normalize_string(track['artist'])
-        name = normalize_string(track['name'])
-        album = normalize_string(track.get('album', ''))
-        date = track['date'].astimezone(timezone.utc).isoformat()
-        query = '''
-        INSERT INTO tracks (artist, name, album, listen_count, last_listened, mbid)
-        VALUES (?, ?, ?, 1, ?, ?)
-        ON CONFLICT(artist, name) DO UPDATE SET
-        listen_count = listen_count + 1,
-        last_listened = ?,
-        album = COALESCE(?, album),
-        mbid = COALESCE(?, mbid)
-        '''
+    def create_indexes(self) -> None:
+        """Create the indexes used by album checks and frequently played track lookups."""
+        with self.connect() as conn:
+            # Covers check_album_conditions' (album, artist) lookup without touching the table
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tracks_album_artist
+                ON tracks (album, artist, name, listen_count)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tracks_processed_count
+                ON tracks (processed, listen_count)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tracks_last_listened_ts
+                ON tracks (last_listened_ts)
+            ''')
+            # Gather planner statistics once, so SQLite knows how selective the new indexes are
+            has_stats = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            ).fetchone()
+            if not has_stats:
+                conn.execute("ANALYZE")
+
+    def add_or_update_tracks(self, tracks: Iterable[Dict]) -> int:
+        """Add or update a batch of tracks in a single transaction."""
+        return self.add_or_update_track_batches([tracks])
+
+    def add_or_update_track_batches(self, batches: Iterable[Iterable[Dict]]) -> int:
+        """
+        Add or update several batches of tracks in a single transaction.
+
+        Each batch is written as soon as it is produced, so batches can be written while
+        later ones are still being fetched. The transaction commits after the last batch;
+        if producing a batch raises, nothing written so far is kept.
+        """
+        total = 0
         with self.connect() as conn:
-            conn.execute(query, (
-                artist,
-                name,
-                album,
-                date,
-                track.get('mbid', ''),
-                date,
-                album,
-                track.get('mbid', '')
-            ))
-        logging.info(f"Added/Updated track in database: {artist} - {name}")
+            conn.execute("BEGIN IMMEDIATE")
+            for tracks in batches:
+                rows = self._track_rows(tracks)
+                conn.executemany(SQL_ADD_OR_UPDATE_TRACK, rows)
+                total += len(rows)
+        logging.info(f"Added/Updated {total} tracks in database.")
+        return total
+
+    @staticmethod
+    def _track_rows(tracks: Iterable[Dict]) -> List[tuple]:
+        """Build SQL_ADD_OR_UPDATE_TRACK parameters for a batch of tracks."""
+        tracks = list(tracks)
+        # Normalize column by column so repeated artists and albums are only processed once
+        artists = normalize_strings(track['artist'] for track in tracks)
+        names = normalize_strings(track['name'] for track in tracks)
+        albums = normalize_strings(track.get('album', '') for track in tracks)
+        rows = []
+        for track, artist, name, album in zip(tracks, artists, names, albums):
+            date = track['date'].astimezone(timezone.utc).isoformat()
+            timestamp = int(track['date'].timestamp())
+            mbid = track.get('mbid', '')
+            rows.append((artist, name, album, date, timestamp, mbid, date, timestamp, album, mbid))
+        return rows
 
     def get_last_update_time(self) -> Optional[datetime]:
         """Get the last time a track was listened to."""
-        query = 'SELECT MAX(last_listened) FROM tracks'
-        with self.connect() as conn:
+        query = 'SELECT MAX(last_listened_ts) FROM tracks'
+        with self.read_connection() as conn:
             result = conn.execute(query).fetchone()
         if result and result[0]:
-            return datetime.fromisoformat(result[0]).replace(tzinfo=timezone.utc)
+            return datetime.fromtimestamp(result[0], tz=timezone.utc)
         return None
 
     def get_frequently_played_tracks(self, min_count: int = 5) -> List[tuple]:
         """Get tracks that have been played frequently."""
-        query = '''
-        SELECT artist, name, listen_count
-        FROM tracks
-        WHERE listen_count >= ? AND processed = 0
-        ORDER BY listen_count DESC
-        '''
-        with self.connect() as conn:
-            return conn.execute(query, (min_count,)).fetchall()
+        with self.read_connection() as conn:
+            return conn.execute(SQL_FREQUENTLY_PLAYED_TRACKS, (min_count,)).fetchall()
 
     def mark_tracks_as_processed(self, tracks: List[tuple]) -> None:
-        """Mark tracks as processed."""
+        """Mark tracks as processed with a single set-based UPDATE."""
+        if not tracks:
+            return
         with self.connect() as conn:
-            c = conn.cursor()
-            for artist, name, _ in tracks:
-                c.execute('''
-                    UPDATE tracks
-                    SET processed = 1
-                    WHERE artist = ? AND name = ?
-                ''', (artist, name))
-            conn.commit()
+            # Take the write lock up front rather than upgrading a read transaction mid-batch
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS processed_keys (artist TEXT, name TEXT)")
+            conn.execute("DELETE FROM processed_keys")
+            conn.executemany("INSERT INTO processed_keys VALUES (?, ?)",
+                             [(artist, name) for artist, name, _ in tracks])
+            conn.execute(SQL_MARK_PROCESSED)
         logging.info(f"Marked {len(tracks)} tracks as processed.")
 
-    def get_albums_since(self, last_update: datetime) -> List[Dict]:
-        """Retrieve all albums listened to since the last update."""
+    def get_album_listen_counts(self, since: Optional[datetime] = None) -> Dict[Tuple[str, str], Tuple[int, int, int]]:
+        """
+        Count the tracks of every (album, artist) in a single aggregate scan.
+
+        Each album maps to (total tracks, tracks listened to, tracks listened to 3+ times).
+        With since, only albums that have a track listened to after that time are included.
+        """
         query = """
-        SELECT DISTINCT album, artist 
-        FROM tracks 
-        WHERE last_listened > ?
+        SELECT album, artist, COUNT(*), SUM(listen_count > 0), SUM(listen_count >= 3)
+        FROM tracks
+        WHERE album IS NOT NULL AND artist IS NOT NULL
         """
+        params = ()
+        if since is not None:
+            query += " AND (album, artist) IN (SELECT album, artist FROM tracks WHERE last_listened_ts > ?)"
+            params = (int(since.timestamp()),)
+        query += " GROUP BY album, artist"
+        with self.read_connection() as conn:
+            return {(row[0], row[1]): row[2:] for row in conn.execute(query, params)}
+
+    def get_track_columns(self) -> Set[str]:
+        """Return the column names of the tracks table."""
         with self.connect() as conn:
-            c = conn.cursor()
-            c.execute(query, (last_update.isoformat(),))
-            albums = [{'name': row[0], 'artist': row[1]} for row in c.fetchall()]
-        logging.info(f"Retrieved {len(albums)} albums since last update.")
-        return albums
-
-    def get_all_albums(self) -> List[Dict]:
-        """Retrieve all unique albums from the tracks table."""
-        query = "SELECT DISTINCT album, artist FROM tracks"
-        with self.connect() as conn:
-            c = conn.cursor()
-            c.execute(query)
-            albums = [{'name': row[0], 'artist': row[1]} for row in c.fetchall()]
-        logging.info(f"Retrieved all albums from the Last.fm database: {len(albums)} albums.")
-        return albums
+            return {row[1] for row in conn.execute("PRAGMA table_info(tracks)")}
 
     def add_processed_column(self) -> None:
         """Add the 'processed' column to the tracks table if it doesn't exist."""
+        if 'processed' in self.get_track_columns():
+            logging.info("'processed' column already exists in tracks table.")
+            return
         with self.connect() as conn:
-            c = conn.cursor()
-            try:
-                c.execute('ALTER TABLE tracks ADD COLUMN processed BOOLEAN DEFAULT 0')
-                conn.commit()
-                logging.info("Added 'processed' column to tracks table.")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    logging.info("'processed' column already exists in tracks table.")
-                else:
-                    logging.error(f"Error adding 'processed' column: {e}", exc_info=True)
-                    raise
+            conn.execute('ALTER TABLE tracks ADD COLUMN processed BOOLEAN DEFAULT 0')
+        logging.info("Added 'processed' column to tracks table.")
+
+    def add_last_listened_ts_column(self) -> None:
+        """Add the integer 'last_listened_ts' column to the tracks table and backfill it from last_listened."""
+        if 'last_listened_ts' in self.get_track_columns():
+            return
+        with self.connect() as conn:
+            conn.execute('ALTER TABLE tracks ADD COLUMN last_listened_ts INTEGER')
+            conn.execute(
+                "UPDATE tracks SET last_listened_ts = CAST(strftime('%s', last_listened) AS INTEGER) "
+                "WHERE last_listened IS NOT NULL"
+            )
+        logging.info("Added 'last_listened_ts' column to tracks table.")
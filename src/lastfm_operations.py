@@ -0,0 +1,139 @@
+# lastfm_operations.py
+
+import logging
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import List, Dict, Iterator, Optional
+from src.utils import RateLimiter
+
+# Parse response bodies with orjson when it is installed; pages of 200 tracks
+# parse several times faster than with the standard library
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+LASTFM_API_URL = 'http://ws.audioscrobbler.com/2.0/'
+LASTFM_PAGE_LIMIT = 200
+LASTFM_MAX_WORKERS = 5
+# Last.fm asks API clients to stay around 5 requests per second
+LASTFM_RATE_LIMIT = 5
+
+def _create_session() -> requests.Session:
+    """Create an HTTP session that keeps connections alive across requests."""
+    session = requests.Session()
+    # No adapter-level retries: _fetch_recent_tracks_page retries failed pages itself,
+    # waiting on the rate limiter before every attempt
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+# Shared by all Last.fm requests so TCP connections are reused across pages and threads
+_SESSION = _create_session()
+# Shared by all page fetches, so parallel workers together stay within the rate limit
+_RATE_LIMITER = RateLimiter(LASTFM_RATE_LIMIT, burst=LASTFM_MAX_WORKERS)
+
+class LastFMFetchError(Exception):
+    pass
+
+def _fetch_recent_tracks_page(params: Dict, page: int, max_retries: int = 5) -> Optional[Dict]:
+    """Fetch a single page of user.getrecenttracks, retrying on network errors."""
+    for attempt in range(max_retries):
+        try:
+            _RATE_LIMITER.wait()
+            response = _SESSION.get(LASTFM_API_URL, params={**params, 'page': page}, timeout=10)
+            response.raise_for_status()
+            data = _json_loads(response.content)
+
+            if 'error' in data:
+                logging.error(f"Error fetching Last.fm tracks: {data['message']}")
+                return None
+            return data['recenttracks']
+        except (requests.RequestException, ValueError) as e:  # ValueError: truncated or invalid JSON body
+            logging.error(f"Network error when fetching Last.fm page {page} (attempt {attempt + 1}/{max_retries}): {e}")
+            if attempt < max_retries - 1:
+                time.sleep(2 ** attempt)  # Back off 1, 2, 4, ... seconds
+        except Exception as e:
+            logging.error(f"Unexpected error fetching Last.fm page {page}: {e}", exc_info=True)
+            return None
+    logging.error(f"Failed to fetch Last.fm page {page} after {max_retries} attempts")
+    return None
+
+def _page_tracks(recenttracks: Dict) -> List[Dict]:
+    """Return the track list of a recenttracks page, which Last.fm collapses to a dict for a single track."""
+    tracks = recenttracks['track']
+    if not isinstance(tracks, list):
+        tracks = [tracks]
+    return tracks
+
+def iter_recent_track_pages(user: str, api_key: str, from_timestamp: Optional[int] = None,
+                            to_timestamp: Optional[int] = None,
+                            max_workers: int = LASTFM_MAX_WORKERS) -> Iterator[List[Dict]]:
+    """
+    Yield a user's scrobbles from Last.fm one page at a time, in page order.
+
+    The first page is fetched on its own to learn the page count; the remaining
+    pages are then fetched concurrently in the background, so the caller can
+    process one page while later pages are still downloading.
+
+    Args:
+        user (str): Last.fm username.
+        api_key (str): Last.fm API key.
+        from_timestamp (int, optional): Unix timestamp to fetch tracks from.
+        to_timestamp (int, optional): Unix timestamp to fetch tracks up to.
+        max_workers (int): Number of pages to fetch in parallel.
+
+    Yields:
+        List[Dict]: Raw track objects of one page as returned by the Last.fm API.
+
+    Raises:
+        LastFMFetchError: If a page after the first cannot be fetched.
+    """
+    params = {
+        'method': 'user.getrecenttracks',
+        'user': user,
+        'api_key': api_key,
+        'format': 'json',
+        'limit': LASTFM_PAGE_LIMIT,
+    }
+    if from_timestamp:
+        params['from'] = from_timestamp
+    if to_timestamp:
+        params['to'] = to_timestamp
+
+    logging.info("Starting to fetch tracks from Last.fm...")
+
+    first_page = _fetch_recent_tracks_page(params, 1)
+    if first_page is None:
+        return
+    tracks = _page_tracks(first_page)
+    total_pages = int(first_page['@attr'].get('totalPages', 1))
+    logging.info(f"Fetched page 1 of {total_pages} ({len(tracks)} tracks)")
+    yield tracks
+
+    if total_pages > 1:
+        pages = iter(range(2, total_pages + 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Keep only a window of pages in flight, so finished pages cannot pile up
+            # in memory while the caller is still busy with earlier ones
+            futures = deque((page, executor.submit(_fetch_recent_tracks_page, params, page))
+                            for page in islice(pages, max_workers * 2))
+            while futures:
+                page, future = futures.popleft()
+                recenttracks = future.result()
+                if recenttracks is None:
+                    # Skipping the page would leave a gap in the history, which the next
+                    # incremental update starts after and would never fill
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise LastFMFetchError(f"Failed to fetch Last.fm page {page} of {total_pages}")
+                for next_page in islice(pages, 1):
+                    futures.append((next_page, executor.submit(_fetch_recent_tracks_page, params, next_page)))
+                tracks = _page_tracks(recenttracks)
+                logging.info(f"Fetched page {page} of {total_pages} ({len(tracks)} tracks)")
+                yield tracks
@@ -7,17 +7,16 @@ import logging
 import sqlite3
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from typing import List, Set, Optional
-import time
-import spotipy
+from typing import Dict, List, Set, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 # Modify the sys.path to include the project root
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
-from src.database import Database
-from src.spotify_operations import SpotifyOperations
-from src.utils import normalize_string, get_user_input_with_timeout
+from src.database import Database, open_connection, close_connection
+from src.spotify_operations import SpotifyOperations, SEARCH_MAX_WORKERS
+from src.utils import normalize_string, get_user_input_with_timeout, terminal_lock
 
 # Load environment variables
 load_dotenv()
@@ -48,6 +47,7 @@ logging.getLogger('').addHandler(console)
 class AlbumSaver:
     def __init__(self):
         """Initialize the AlbumSaver class."""
+        self._conn: Optional[sqlite3.Connection] = None
         self.lastfm_db = Database(db_file=LASTFM_DB_FILE)
         self.spotify_ops = SpotifyOperations(db_file=SPOTIFY_DB_FILE)
         self.sp = self.spotify_ops.sp  # Use the Spotify client from SpotifyOperations
@@ -55,9 +55,25 @@ class AlbumSaver:
         self.saved_albums = self.get_all_saved_albums()  # Load saved albums from local database
         self.removed_albums = self.get_removed_albums()  # Load removed albums from removed_albums.db
 
+    def connect(self) -> sqlite3.Connection:
+        """Return the long-lived connection to the album_saver database, opening it on first use."""
+        if self._conn is None:
+            self._conn = open_connection(ALBUM_SAVER_DB_FILE)
+            # Lets queries join Last.fm tracks against saved_albums in one statement
+            self._conn.execute("ATTACH DATABASE ? AS lastfm", (LASTFM_DB_FILE,))
+        return self._conn
+
+    def close(self) -> None:
+        """Close the database connections."""
+        if self._conn is not None:
+            close_connection(self._conn)
+            self._conn = None
+        self.lastfm_db.close()
+        self.spotify_ops.close()
+
     def create_album_saver_table(self) -> None:
         """Create the necessary tables in the album_saver database."""
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
+        conn = self.connect()
         c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS saved_albums (
@@ -67,6 +83,7 @@ class AlbumSaver:
                 last_checked DATETIME
             )
         ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_saved_albums_name_artist ON saved_albums (name, artist)')
         c.execute('''
             CREATE TABLE IF NOT EXISTS metadata (
                 key TEXT PRIMARY KEY,
@@ -74,89 +91,109 @@ class AlbumSaver:
             )
         ''')
         conn.commit()
-        conn.close()
         logging.info("Initialized album_saver database tables.")
 
     def fetch_saved_albums(self) -> None:
         """Fetch saved albums from Spotify and store them in the album_saver database."""
         offset = 0
         limit = 50
-        all_albums = []
+        total_albums = 0
+        conn = self.connect()
 
         logging.info("Fetching saved albums from Spotify...")
         while True:
-            results = self.sp.current_user_saved_albums(limit=limit, offset=offset)
+            results = self.spotify_ops.api_call_with_retry(self.sp.current_user_saved_albums,
+                                                           limit=limit, offset=offset)
             albums = results['items']
             if not albums:
                 break
-            all_albums.extend(albums)
-            offset += limit
-            time.sleep(0.1)  # Respect rate limits
-
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
-        c = conn.cursor()
-
-        for item in all_albums:
-            album = item['album']
-            name = normalize_string(album['name'])
-            artist = normalize_string(album['artists'][0]['name'])
-            album_id = album['id']
-            added_at = item['added_at']
-            c.execute("INSERT OR REPLACE INTO saved_albums VALUES (?, ?, ?, ?)",
-                      (album_id, name, artist, added_at))
 
-        conn.commit()
-        conn.close()
+            # Store each page as it arrives instead of collecting the whole library first
+            rows = []
+            for item in albums:
+                album = item['album']
+                name = normalize_string(album['name'])
+                artist = normalize_string(album['artists'][0]['name'])
+                album_id = album['id']
+                added_at = item['added_at']
+                rows.append((album_id, name, artist, added_at))
+                self.saved_albums.add((name, artist))  # Keep the in-memory set in step with the table
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO saved_albums VALUES (?, ?, ?, ?)", rows)
+
+            total_albums += len(albums)
+            offset += limit
 
-        logging.info(f"Fetched and stored {len(all_albums)} saved albums.")
+        logging.info(f"Fetched and stored {total_albums} saved albums.")
 
     def get_all_saved_albums(self) -> Set[tuple]:
         """Retrieve all saved albums (normalized name and artist) from the album_saver database."""
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
+        conn = self.connect()
         c = conn.cursor()
         c.execute("SELECT name, artist FROM saved_albums")
         saved_albums = set((row[0], row[1]) for row in c.fetchall())
-        conn.close()
         logging.info(f"Retrieved {len(saved_albums)} saved albums from album_saver database.")
         return saved_albums
 
+    def get_unsaved_albums(self, since: Optional[datetime] = None) -> List[Dict]:
+        """
+        Retrieve the Last.fm albums that are not in saved_albums, optionally only those listened to since a time.
+
+        The Last.fm database is attached to the album_saver connection, so already saved
+        albums are filtered out by SQLite instead of being returned and skipped in Python.
+        """
+        query = '''
+            SELECT DISTINCT t.album, t.artist
+            FROM lastfm.tracks t
+            WHERE NOT EXISTS (
+                SELECT 1 FROM saved_albums s WHERE s.name = t.album AND s.artist = t.artist
+            )
+        '''
+        params = ()
+        if since is not None:
+            query += " AND t.last_listened_ts > ?"
+            params = (int(since.timestamp()),)
+        c = self.connect().cursor()
+        c.execute(query, params)
+        albums = [{'name': row[0], 'artist': row[1]} for row in c.fetchall()]
+        logging.info(f"Retrieved {len(albums)} albums not yet saved from the Last.fm database.")
+        return albums
+
     def get_removed_albums(self) -> Set[tuple]:
         """Retrieve all removed albums (normalized name and artist) from the removed_albums database."""
         if not os.path.exists(REMOVED_ALBUMS_DB_FILE):
             logging.info("No removed_albums.db found. No albums will be excluded based on previous removals.")
             return set()
 
+        # Nothing here writes this file, so open it plainly rather than switching it to WAL
         conn = sqlite3.connect(REMOVED_ALBUMS_DB_FILE)
+        conn.create_function('normalize', 1, normalize_string, deterministic=True)
         c = conn.cursor()
-        c.execute("SELECT album_name, artist_name FROM removed_albums")
-        removed_albums = set(
-            (normalize_string(row[0]), normalize_string(row[1])) for row in c.fetchall()
-        )
+        c.execute("SELECT DISTINCT normalize(album_name), normalize(artist_name) FROM removed_albums")
+        removed_albums = set((row[0], row[1]) for row in c.fetchall())
         conn.close()
         logging.info(f"Loaded {len(removed_albums)} albums from removed_albums.db to exclude.")
         return removed_albums
 
     def get_last_update_time(self) -> Optional[datetime]:
         """Retrieve the last update time from the metadata table."""
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
+        conn = self.connect()
         c = conn.cursor()
         c.execute("SELECT value FROM metadata WHERE key = 'last_update'")
         result = c.fetchone()
-        conn.close()
         if result and result[0]:
             return datetime.fromisoformat(result[0]).astimezone(timezone.utc)
         return None
 
     def set_last_update_time(self, update_time: datetime) -> None:
         """Set the last update time in the metadata table."""
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
+        conn = self.connect()
         c = conn.cursor()
         c.execute(
             "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
             ('last_update', update_time.astimezone(timezone.utc).isoformat())
         )
         conn.commit()
-        conn.close()
         logging.info(f"Set last update time to: {update_time.isoformat()}")
 
     def process_albums(self, force_full_check: bool = False) -> None:
@@ -164,23 +201,26 @@ class AlbumSaver:
         last_update = self.get_last_update_time()
         if force_full_check or last_update is None:
             logging.info("Performing full album check.")
-            albums_to_check = self.lastfm_db.get_all_albums()
+            albums_to_check = self.get_unsaved_albums()
+            album_counts = self.lastfm_db.get_album_listen_counts()
         else:
             logging.info(f"Checking albums updated since {last_update.isoformat()}")
-            albums_to_check = self.lastfm_db.get_albums_since(last_update)
+            albums_to_check = self.get_unsaved_albums(since=last_update)
+            album_counts = self.lastfm_db.get_album_listen_counts(since=last_update)
 
         logging.info(f"Found {len(albums_to_check)} albums to check.")
 
-        new_albums_added = 0
+        albums_to_search = {}
         for index, album in enumerate(albums_to_check, 1):
             try:
                 album_name = album['name']
                 artist_name = album['artist']
-                normalized_album = normalize_string(album_name)
-                normalized_artist = normalize_string(artist_name)
+                # The Last.fm database stores names already normalized by add_or_update_tracks
+                normalized_album = album_name
+                normalized_artist = artist_name
 
                 # Skip 'Various Artists'
-                if 'various artists' in normalized_artist.lower():
+                if 'various artists' in normalized_artist:
                     logging.info(f"Skipping 'Various Artists' album: {artist_name} - {album_name}")
                     continue
 
@@ -192,42 +232,53 @@ class AlbumSaver:
                 logging.info(f"Processing album {index}/{len(albums_to_check)}: {artist_name} - {album_name}")
 
                 # Check if album meets criteria based on Last.fm data
-                if self.check_album_conditions(album_name, artist_name):
+                if self.check_album_conditions(album_name, artist_name, album_counts.get((album_name, artist_name), (0, 0, 0))):
                     logging.info(f"Album meets criteria: {artist_name} - {album_name}")
                     # Check if album is already saved on Spotify
-                    if (normalized_album, normalized_artist) not in self.saved_albums:
-                        # Search for album on Spotify
-                        album_id = self.spotify_ops.search_album(album_name, artist_name)
-                        if album_id:
-                            self.save_album_to_library(album_id, album_name, artist_name)
-                            new_albums_added += 1
-                            self.saved_albums.add((normalized_album, normalized_artist))  # Update the saved albums set
-                        else:
-                            logging.info(f"Album not found on Spotify: {artist_name} - {album_name}")
-                    else:
+                    if (normalized_album, normalized_artist) in self.saved_albums:
                         logging.info(f"Album already saved on Spotify: {artist_name} - {album_name}")
+                    elif (normalized_album, normalized_artist) not in albums_to_search:
+                        # The search query is built from the normalized names, so one search per key is enough
+                        albums_to_search[(normalized_album, normalized_artist)] = (album_name, artist_name)
                 else:
                     logging.info(f"Album does not meet criteria: {artist_name} - {album_name}")
             except Exception as e:
                 logging.error(f"Error processing album {artist_name} - {album_name}: {e}", exc_info=True)
                 continue  # Continue processing next album
 
+        # Search for the qualifying albums on Spotify concurrently; results come back in order
+        albums_to_save = []
+        with ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS) as executor:
+            album_ids = executor.map(lambda album: self.spotify_ops.search_album(*album), albums_to_search.values())
+            for (key, (album_name, artist_name)), album_id in zip(albums_to_search.items(), album_ids):
+                if album_id:
+                    albums_to_save.append((album_id, album_name, artist_name))
+                    self.saved_albums.add(key)  # Update the saved albums set
+                else:
+                    logging.info(f"Album not found on Spotify: {artist_name} - {album_name}")
+
+        new_albums_added = self.save_albums_to_library(albums_to_save)
         logging.info(f"Processed {len(albums_to_check)} albums. Added {new_albums_added} new albums.")
         self.set_last_update_time(datetime.now(timezone.utc))
 
-    def check_album_conditions(self, album_name: str, artist_name: str) -> bool:
-        """Check if an album meets the criteria to be saved based on Last.fm data."""
+    def check_album_conditions(self, album_name: str, artist_name: str,
+                               counts: Optional[Tuple[int, int, int]] = None) -> bool:
+        """
+        Check if an album meets the criteria to be saved based on Last.fm data.
+
+        counts is the album's (total, listened, listened 3+ times) track counts if already
+        loaded, e.g. by Database.get_album_listen_counts; otherwise they are queried here.
+        """
         logging.info(f"Starting to check album conditions for album: {artist_name} - {album_name}")
         try:
-            conn = sqlite3.connect(LASTFM_DB_FILE)
-            c = conn.cursor()
-            c.execute(
-                "SELECT name, listen_count FROM tracks WHERE album = ? AND artist = ?",
-                (album_name, artist_name)
-            )
-            tracks = c.fetchall()
-            conn.close()
-            total_tracks = len(tracks)
+            if counts is None:
+                conn = self.lastfm_db.read_connection()
+                counts = conn.execute(
+                    "SELECT COUNT(*), SUM(listen_count > 0), SUM(listen_count >= 3) "
+                    "FROM tracks WHERE album = ? AND artist = ?",
+                    (album_name, artist_name)
+                ).fetchone()
+            total_tracks, listened_tracks, tracks_listened_3_times = counts
             if total_tracks == 0:
                 logging.info(f"No tracks found for album {artist_name} - {album_name} in Last.fm database.")
                 return False
@@ -236,9 +287,6 @@ class AlbumSaver:
                 return False
             logging.info(f"Found {total_tracks} tracks for album {artist_name} - {album_name}")
 
-            listened_tracks = sum(1 for track in tracks if track[1] > 0)
-            tracks_listened_3_times = sum(1 for track in tracks if track[1] >= 3)
-
             condition1 = listened_tracks >= 0.75 * total_tracks
             condition2 = tracks_listened_3_times >= 3
 
@@ -251,37 +299,53 @@ class AlbumSaver:
             logging.error(f"Error checking album conditions for {artist_name} - {album_name}: {e}", exc_info=True)
             return False
 
-    def save_album_to_library(self, album_id: str, album_name: str, artist_name: str) -> None:
-        """Save an album to the Spotify library."""
-        try:
-            logging.info(f"Saving album: {artist_name} - {album_name}")
-            # Save the album to the library
-            self.sp.current_user_saved_albums_add([album_id])
-            logging.info(f"Album saved: {artist_name} - {album_name}")
-            self.update_saved_album(album_id, album_name, artist_name)
-        except Exception as e:
-            logging.error(f"Error saving album {album_id}: {e}", exc_info=True)
+    def save_albums_to_library(self, albums: List[Tuple[str, str, str]]) -> int:
+        """Save (album_id, album_name, artist_name) albums to the Spotify library in batches, returning the number saved."""
+        batch_size = 20  # Spotify allows up to 20 albums per request
+        albums = list({album[0]: album for album in albums}.values())  # One request slot per album ID
+        saved_count = 0
+        for i in range(0, len(albums), batch_size):
+            batch = albums[i:i+batch_size]
+            try:
+                logging.info(f"Saving {len(batch)} albums: " + ", ".join(f"{artist} - {name}" for _, name, artist in batch))
+                # Save the albums to the library
+                self.sp.current_user_saved_albums_add([album_id for album_id, _, _ in batch])
+                logging.info(f"Saved {len(batch)} albums to the Spotify library.")
+                self.update_saved_albums(batch)
+                saved_count += len(batch)
+            except Exception as e:
+                logging.error(f"Error saving albums {[album_id for album_id, _, _ in batch]}: {e}", exc_info=True)
+        return saved_count
 
-    def update_saved_album(self, album_id: str, album_name: str, artist_name: str) -> None:
-        """Update the saved_albums table with the new album."""
-        conn = sqlite3.connect(ALBUM_SAVER_DB_FILE)
-        c = conn.cursor()
+    def update_saved_albums(self, albums: List[Tuple[str, str, str]]) -> None:
+        """Update the saved_albums table with newly saved (album_id, album_name, artist_name) albums."""
         now = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
-        c.execute(
-            "INSERT OR REPLACE INTO saved_albums (id, name, artist, last_checked) VALUES (?, ?, ?, ?)",
-            (album_id, normalize_string(album_name), normalize_string(artist_name), now)
-        )
-        conn.commit()
-        conn.close()
-        logging.info(f"Updated album_saver database for album: {artist_name} - {album_name}")
+        rows = [(album_id, normalize_string(album_name), normalize_string(artist_name), now)
+                for album_id, album_name, artist_name in albums]
+        # Update in place on a known ID rather than REPLACE's delete-and-reinsert
+        with self.connect() as conn:
+            conn.executemany('''
+                INSERT INTO saved_albums (id, name, artist, last_checked) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                name = excluded.name,
+                artist = excluded.artist,
+                last_checked = excluded.last_checked
+            ''', rows)
+        logging.info(f"Updated album_saver database for {len(rows)} albums.")
 
 def main():
+    album_saver = None
     try:
         album_saver = AlbumSaver()
 
-        # Prompt the user for full or update check
-        prompt = "Do you want to perform a full check or an update check? (Enter 'full' or 'update' within 10 seconds, default is 'update'): "
-        user_choice = get_user_input_with_timeout(prompt, timeout=10)
+        # main.py runs this script alongside hot_100_playlist.py, so hold the terminal
+        # while authorizing with Spotify, which may prompt for a login, and while asking
+        with terminal_lock():
+            album_saver.sp.auth_manager.get_access_token(as_dict=False)
+
+            # Prompt the user for full or update check
+            prompt = "Do you want to perform a full check or an update check? (Enter 'full' or 'update' within 10 seconds, default is 'update'): "
+            user_choice = get_user_input_with_timeout(prompt, timeout=10)
 
         if user_choice.lower() == 'full':
             force_full_check = True
@@ -291,13 +355,15 @@ def main():
             logging.info("Proceeding with update check.")
 
         # Fetch saved albums from Spotify and update local database
-        album_saver.fetch_saved_albums()
-        album_saver.saved_albums = album_saver.get_all_saved_albums()  # Refresh saved albums set
+        album_saver.fetch_saved_albums()  # Also adds the fetched albums to album_saver.saved_albums
 
         album_saver.process_albums(force_full_check)
 
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}", exc_info=True)
+    finally:
+        if album_saver is not None:
+            album_saver.close()
 
 if __name__ == "__main__":
     main()
@@ -3,24 +3,27 @@
 
 import os
 import sys
-import re
 import sqlite3
 import logging
 import random
-import requests
 import time
+from itertools import chain, islice
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-from rapidfuzz import fuzz
-from typing import List, Dict, Tuple, Optional
+from rapidfuzz import fuzz, process
+from typing import List, Dict, Iterable, Iterator, Tuple, Optional
 
 # Modify the sys.path to include the project root
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
-from src.utils import normalize_string, get_user_input_with_timeout
+from src.database import open_connection, close_connection
+from src.lastfm_operations import iter_recent_track_pages
+from src.spotify_operations import MemoizedCacheFileHandler, SEARCH_RATE_LIMIT
+from src.utils import sort_tokens, RateLimiter, terminal_lock
 
 # Load environment variables
 load_dotenv()
@@ -42,6 +45,33 @@ DEFAULT_PLAYLIST_NAME = "Bobby's Hot 💯"
 PLAYLIST_ID_FILE = 'playlist_id.txt'
 DEFAULT_TIME_RANGE_DAYS = 100
 DEFAULT_TRACK_LIMIT = 100
+SEARCH_MAX_WORKERS = 8
+PLAYLIST_ADD_WORKERS = 4
+PLAYLIST_BATCH_SIZE = 100  # Spotify accepts up to 100 tracks per playlist request
+# Paces Spotify requests from all worker threads together, so they don't run into 429 back-offs
+SPOTIFY_RATE_LIMITER = RateLimiter(SEARCH_RATE_LIMIT, burst=SEARCH_MAX_WORKERS)
+NOT_FOUND_CACHE_TTL_DAYS = 7
+
+# A search result is accepted when its weighted artist, name and album score exceeds MATCH_THRESHOLD
+MATCH_THRESHOLD = 75
+ARTIST_WEIGHT, NAME_WEIGHT, ALBUM_WEIGHT = 0.3, 0.4, 0.3
+# Lowest name score that can still exceed MATCH_THRESHOLD with perfect artist and album scores
+NAME_SCORE_CUTOFF = (MATCH_THRESHOLD - 100 * (ARTIST_WEIGHT + ALBUM_WEIGHT)) / NAME_WEIGHT
+
+# Statements run with executemany, kept as constants so each compiles once
+# per connection and is then reused from the statement cache
+SQL_INSERT_TRACK = '''
+INSERT OR REPLACE INTO tracks (artist, name, album, play_count, last_played)
+VALUES (?, ?, ?, ?, ?)
+'''
+
+SQL_SAVE_SEARCH_RESULT = '''
+INSERT INTO search_cache (artist, name, track_id, cached_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT(artist, name) DO UPDATE SET
+track_id = excluded.track_id,
+cached_at = CASE WHEN track_id = excluded.track_id THEN cached_at ELSE excluded.cached_at END
+'''
 
 # Ensure the 'logs' directory exists
 logs_dir = os.path.join(project_root, 'logs')
@@ -64,10 +94,21 @@ logging.getLogger('').addHandler(console)
 class LastFM100DaysDB:
     def __init__(self, db_file: str):
         self.db_file = db_file
+        self._conn: Optional[sqlite3.Connection] = None
         self.create_table()
 
+    def connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_connection(self.db_file)
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            close_connection(self._conn)
+            self._conn = None
+
     def create_table(self) -> None:
-        with sqlite3.connect(self.db_file) as conn:
+        with self.connect() as conn:
             c = conn.cursor()
             c.execute('''CREATE TABLE IF NOT EXISTS tracks
                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -77,34 +118,40 @@ class LastFM100DaysDB:
                           play_count INTEGER,
                           last_played TEXT,
                           UNIQUE(artist, name, album))''')
+            c.execute('''CREATE TABLE IF NOT EXISTS search_cache
+                         (artist TEXT,
+                          name TEXT,
+                          track_id TEXT,
+                          cached_at TEXT,
+                          PRIMARY KEY (artist, name))''')
+            # Lets get_all_tracks read rows in ranking order without sorting the table
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_tracks_play_count
+                         ON tracks (play_count DESC, last_played DESC)''')
             conn.commit()
         logging.info("Initialized tracks table in Last.fm 100 Days database.")
 
-    def update_tracks(self, tracks: List[Dict]) -> None:
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            # Clear existing data
-            c.execute("DELETE FROM tracks")
-            for track in tracks:
-                c.execute('''INSERT OR REPLACE INTO tracks 
-                             (artist, name, album, play_count, last_played)
-                             VALUES (?, ?, ?, ?, ?)''',
-                          (track['artist'], track['name'], track['album'], 
-                           track['play_count'], track['last_played'].isoformat()))
-            conn.commit()
-        logging.info(f"Updated database with {len(tracks)} tracks.")
-
-    def remove_old_tracks(self, cut_off_date: datetime) -> None:
-        with sqlite3.connect(self.db_file) as conn:
-            c = conn.cursor()
-            cut_off_date_str = cut_off_date.isoformat()
-            c.execute("DELETE FROM tracks WHERE last_played < ?", (cut_off_date_str,))
-            removed = c.rowcount
-            conn.commit()
-        logging.info(f"Removed {removed} tracks older than {cut_off_date_str}.")
+    def replace_tracks(self, tracks: List[Dict], cut_off_date: datetime) -> None:
+        """
+        Replace the stored tracks with those last played on or after cut_off_date.
+
+        last_played is a Unix timestamp, as produced by process_lastfm_tracks.
+        """
+        cut_off_uts = cut_off_date.timestamp()
+        recent_tracks = [track for track in tracks if track['last_played'] >= cut_off_uts]
+        with self.connect() as conn:
+            # Clear and refill the table in one write transaction, taking the lock up front
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM tracks")
+            conn.executemany(SQL_INSERT_TRACK,
+                             ((track['artist'], track['name'], track['album'],
+                               track['play_count'],
+                               datetime.fromtimestamp(track['last_played'], tz=timezone.utc).isoformat())
+                              for track in recent_tracks))
+        logging.info(f"Updated database with {len(recent_tracks)} tracks, "
+                     f"skipped {len(tracks) - len(recent_tracks)} older than {cut_off_date.isoformat()}.")
 
     def get_all_tracks(self) -> List[Tuple]:
-        with sqlite3.connect(self.db_file) as conn:
+        with self.connect() as conn:
             c = conn.cursor()
             c.execute('''SELECT artist, name, album, play_count FROM tracks
                          ORDER BY play_count DESC, last_played DESC''')
@@ -112,61 +159,45 @@ class LastFM100DaysDB:
         logging.info(f"Retrieved {len(all_tracks)} tracks from the database.")
         return all_tracks
 
-def get_lastfm_tracks(from_date: datetime, to_date: datetime) -> List[Dict]:
-    url = 'http://ws.audioscrobbler.com/2.0/'
-    params = {
-        'method': 'user.getrecenttracks',
-        'user': LASTFM_USER,
-        'api_key': LASTFM_API_KEY,
-        'format': 'json',
-        'limit': 200,
-        'from': int(from_date.timestamp()),
-        'to': int(to_date.timestamp())
-    }
-
-    all_tracks = []
-    page = 1
-
-    logging.info("Starting to fetch tracks from Last.fm...")
-
-    while True:
-        params['page'] = page
-        try:
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            if 'error' in data:
-                logging.error(f"Error fetching Last.fm tracks: {data['message']}")
-                break
-
-            tracks = data['recenttracks']['track']
-            if not isinstance(tracks, list):
-                tracks = [tracks]
-            all_tracks.extend(tracks)
-
-            total_pages = int(data['recenttracks']['@attr']['totalPages'])
-            logging.info(f"Fetched page {page} of {total_pages} ({len(tracks)} tracks)")
-
-            if page >= total_pages:
-                break
-            page += 1
-            time.sleep(0.2)  # Sleep to respect API rate limits
-
-        except requests.RequestException as e:
-            logging.error(f"Network error when fetching Last.fm tracks: {e}")
-            time.sleep(5)
-            continue  # Retry on network errors
-        except Exception as e:
-            logging.error(f"Unexpected error in get_lastfm_tracks: {e}", exc_info=True)
-            break
+    def load_search_cache(self) -> Dict[Tuple[str, str], Optional[str]]:
+        """Load cached Spotify search results, dropping negative results older than the TTL."""
+        cut_off = datetime.now(timezone.utc) - timedelta(days=NOT_FOUND_CACHE_TTL_DAYS)
+        with self.connect() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM search_cache WHERE track_id = 'NOT_FOUND' AND cached_at < ?",
+                      (cut_off.isoformat(),))
+            c.execute("SELECT artist, name, track_id FROM search_cache")
+            rows = c.fetchall()
+            conn.commit()
+        search_cache = {
+            (artist, name): track_id if track_id != 'NOT_FOUND' else None
+            for artist, name, track_id in rows
+        }
+        logging.info(f"Loaded {len(search_cache)} cached Spotify search results.")
+        return search_cache
+
+    def save_search_cache(self, search_cache: Dict[Tuple[str, str], Optional[str]]) -> None:
+        """Store Spotify search results, keeping the original timestamp of existing entries."""
+        if not search_cache:
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        with self.connect() as conn:
+            conn.executemany(SQL_SAVE_SEARCH_RESULT,
+                             [(artist, name, track_id or 'NOT_FOUND', now)
+                              for (artist, name), track_id in search_cache.items()])
+            conn.commit()
+        logging.info(f"Saved {len(search_cache)} Spotify search results to cache.")
 
-    logging.info(f"Fetched a total of {len(all_tracks)} tracks from Last.fm")
-    return all_tracks
+def get_lastfm_tracks(from_date: datetime, to_date: datetime) -> Iterator[Dict]:
+    """Yield scrobbles as their pages arrive, so processing overlaps the remaining downloads."""
+    return chain.from_iterable(iter_recent_track_pages(LASTFM_USER, LASTFM_API_KEY,
+                                                       from_timestamp=int(from_date.timestamp()),
+                                                       to_timestamp=int(to_date.timestamp())))
 
-def process_lastfm_tracks(tracks: List[Dict]) -> List[Dict]:
+def process_lastfm_tracks(tracks: Iterable[Dict]) -> List[Dict]:
     processed_tracks = {}
-    now = datetime.now(timezone.utc)
+    # Work with raw Unix timestamps throughout; replace_tracks formats them when storing.
+    # The time range is applied by the Last.fm request and by replace_tracks' cut-off.
 
     logging.info("Processing Last.fm tracks...")
 
@@ -175,25 +206,24 @@ def process_lastfm_tracks(tracks: List[Dict]) -> List[Dict]:
             if 'date' not in track:
                 continue  # Skip currently playing track
 
+            uts = int(track['date']['uts'])
             artist = track['artist']['#text']
             name = track['name']
-            album = track['album']['#text'] if track['album']['#text'] else 'Unknown Album'
-            date = datetime.fromtimestamp(int(track['date']['uts']), tz=timezone.utc)
-
-            if (now - date).days > DEFAULT_TIME_RANGE_DAYS:
-                continue
+            album = track['album']['#text'] or 'Unknown Album'
 
             key = (artist.lower(), name.lower(), album.lower())
-            if key in processed_tracks:
-                processed_tracks[key]['play_count'] += 1
-                processed_tracks[key]['last_played'] = max(processed_tracks[key]['last_played'], date)
+            entry = processed_tracks.get(key)
+            if entry is not None:
+                entry['play_count'] += 1
+                if uts > entry['last_played']:
+                    entry['last_played'] = uts
             else:
                 processed_tracks[key] = {
                     'artist': artist,
                     'name': name,
                     'album': album,
                     'play_count': 1,
-                    'last_played': date
+                    'last_played': uts
                 }
         except Exception as e:
             logging.error(f"Error processing track: {track}", exc_info=True)
@@ -202,6 +232,135 @@ def process_lastfm_tracks(tracks: List[Dict]) -> List[Dict]:
     logging.info(f"Processed {len(processed_tracks)} unique tracks.")
     return list(processed_tracks.values())
 
+def search_spotify_track(sp: spotipy.Spotify, artist: str, name: str, album: str,
+                         max_retries: int = 3) -> Optional[str]:
+    """Search Spotify for a track and return the ID of the best fuzzy match, if any."""
+    query = f"track:{name} artist:{artist}"
+    for attempt in range(max_retries):
+        try:
+            SPOTIFY_RATE_LIMITER.wait()
+            results = sp.search(q=query, type='track', limit=10)
+            break
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status == 429 and attempt < max_retries - 1:
+                retry_after = int((e.headers or {}).get('Retry-After', 2 ** attempt))
+                logging.warning(f"Rate limited searching for {artist} - {name}, retrying in {retry_after} seconds...")
+                time.sleep(retry_after)
+            else:
+                raise
+
+    # Token-sort the probe once; fuzz.ratio on token-sorted strings equals fuzz.token_sort_ratio,
+    # and sort_tokens memoizes the candidates' names, which recur across searches
+    artist_key, name_key, album_key = (sort_tokens(s.lower()) for s in (artist, name, album))
+    items = results['tracks']['items']
+    # Score every candidate name in one call; those below the cutoff cannot be accepted,
+    # so their artist and album are never scored
+    name_scores = {
+        index: score
+        for _, score, index in process.extract(
+            name_key, {index: sort_tokens(item['name'].lower()) for index, item in enumerate(items)},
+            scorer=fuzz.ratio, processor=None, limit=None, score_cutoff=NAME_SCORE_CUTOFF
+        )
+    }
+    best_match = None
+    highest_score = 0
+    # Walk the survivors in result order so ties keep going to Spotify's higher-ranked result
+    for index in sorted(name_scores):
+        item = items[index]
+        name_score = name_scores[index]
+        # Each cutoff is the lowest score that can still exceed MATCH_THRESHOLD given the scores
+        # known so far; below it fuzz.ratio exits early and returns 0
+        artist_cutoff = (MATCH_THRESHOLD - name_score * NAME_WEIGHT - 100 * ALBUM_WEIGHT) / ARTIST_WEIGHT
+        artist_score = fuzz.ratio(artist_key, sort_tokens(item['artists'][0]['name'].lower()),
+                                  processor=None, score_cutoff=max(artist_cutoff, 0))
+        if not artist_score:
+            continue
+        album_cutoff = (MATCH_THRESHOLD - name_score * NAME_WEIGHT - artist_score * ARTIST_WEIGHT) / ALBUM_WEIGHT
+        album_score = fuzz.ratio(album_key, sort_tokens(item['album']['name'].lower()),
+                                 processor=None, score_cutoff=max(album_cutoff, 0))
+        if not album_score:
+            continue
+        total_score = (artist_score * ARTIST_WEIGHT) + (name_score * NAME_WEIGHT) + (album_score * ALBUM_WEIGHT)
+        if total_score > highest_score:
+            highest_score = total_score
+            best_match = item
+            if total_score == 100:
+                break
+    if highest_score > MATCH_THRESHOLD and best_match:
+        logging.info(f"Found match with score {highest_score:.2f}: {best_match['artists'][0]['name']} - "
+                     f"{best_match['name']} (Album: {best_match['album']['name']})")
+        return best_match['id']
+    logging.warning(f"No suitable match found for: {artist} - {name} (Album: {album})")
+    return None
+
+def find_spotify_track_ids(sp: spotipy.Spotify, tracks: Iterable[Dict], track_limit: int,
+                           search_cache: Optional[Dict[Tuple[str, str], Optional[str]]] = None,
+                           max_workers: int = SEARCH_MAX_WORKERS) -> List[str]:
+    """
+    Search Spotify for tracks in order until track_limit matches are found, using a thread pool.
+
+    tracks is consumed lazily, so no more of it is read than the searches need.
+
+    search_cache maps (artist, name) in lower case to a track ID, or None when no match was
+    found. Cached keys are not searched again, and new results are added to it in place.
+    """
+    if search_cache is None:
+        search_cache = {}
+    spotify_track_ids = []
+    seen = set()
+
+    def search(track_info: Dict) -> Tuple[bool, Optional[str]]:
+        artist = track_info['artist']
+        name = track_info['name']
+        album = track_info['album']
+        logging.info(f"Searching for track: {artist} - {name} (Album: {album}, Play count: {track_info['play_count']})")
+        try:
+            return True, search_spotify_track(sp, artist, name, album)
+        except Exception as e:
+            logging.error(f"Error searching for track on Spotify: {e}", exc_info=True)
+            return False, None
+
+    tracks = iter(tracks)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(spotify_track_ids) < track_limit:
+            # Search as many tracks as are still needed to fill the playlist, but at least one
+            # per worker so the last rounds keep every worker busy; surplus results are cached
+            batch = list(islice(tracks, max(track_limit - len(spotify_track_ids), max_workers)))
+            if not batch:
+                break
+            keys = []
+            pending = []
+            for track_info in batch:
+                key = (track_info['artist'].lower(), track_info['name'].lower())
+                if key in seen:
+                    continue
+                seen.add(key)
+                keys.append(key)
+                if key not in search_cache:
+                    pending.append((key, track_info))
+            for (key, _), (searched, track_id) in zip(pending, executor.map(search, [t for _, t in pending])):
+                if searched:
+                    # Errors are not cached so the track is retried on the next run
+                    search_cache[key] = track_id
+            # Take cached and searched matches in rank order, so surplus results from this
+            # batch never push a higher-ranked track out of the playlist
+            for key in keys:
+                if search_cache.get(key) and len(spotify_track_ids) < track_limit:
+                    spotify_track_ids.append(search_cache[key])
+
+    return spotify_track_ids[:track_limit]
+
+def find_playlist_id(sp: spotipy.Spotify, name: str, user_id: str) -> Optional[str]:
+    """Find a playlist owned by the current user by name, paging through all of their playlists."""
+    results = sp.current_user_playlists(limit=50)
+    while results:
+        for playlist in results['items']:
+            # The list also holds followed playlists, which belong to other users and cannot be edited
+            if playlist['name'] == name and playlist['owner']['id'] == user_id:
+                return playlist['id']
+        results = sp.next(results) if results['next'] else None
+    return None
+
 def get_or_create_playlist(sp: spotipy.Spotify, name: str) -> str:
     playlist_id_file = PLAYLIST_ID_FILE
 
@@ -209,27 +368,31 @@ def get_or_create_playlist(sp: spotipy.Spotify, name: str) -> str:
     if os.path.exists(playlist_id_file):
         with open(playlist_id_file, 'r') as f:
             playlist_id = f.read().strip()
-        # Verify that the playlist still exists and is accessible
+        # Verify that the playlist still exists and is accessible; only its name is needed
         try:
-            playlist = sp.playlist(playlist_id)
+            playlist = sp.playlist(playlist_id, fields='name')
             if playlist['name'] == name:
                 logging.info(f"Found existing playlist: {playlist['name']}")
                 return playlist_id
             else:
                 logging.info(f"Updating playlist name to: {name}")
-                sp.user_playlist_change_details(sp.me()['id'], playlist_id, name=name)
+                sp.playlist_change_details(playlist_id, name=name)
                 return playlist_id
         except spotipy.exceptions.SpotifyException as e:
-            logging.warning(f"Playlist ID not valid or playlist not found. Creating new playlist.")
+            logging.warning(f"Playlist ID not valid or playlist not found. Looking for playlist by name.")
 
-    # Playlist ID not found or invalid, create a new playlist
-    logging.info(f"Creating new playlist: {name}")
+    # Playlist ID not found or invalid, reuse a playlist with the same name if there is one
     user_id = sp.me()['id']
-    playlist = sp.user_playlist_create(user_id, name, public=False)
-    # Store the new playlist ID
+    playlist_id = find_playlist_id(sp, name, user_id)
+    if playlist_id:
+        logging.info(f"Found existing playlist by name: {name}")
+    else:
+        logging.info(f"Creating new playlist: {name}")
+        playlist_id = sp.user_playlist_create(user_id, name, public=False)['id']
+    # Store the playlist ID
     with open(playlist_id_file, 'w') as f:
-        f.write(playlist['id'])
-    return playlist['id']
+        f.write(playlist_id)
+    return playlist_id
 
 def update_playlist(sp: spotipy.Spotify, playlist_id: str, track_ids: List[str]) -> None:
     logging.info(f"Updating playlist {playlist_id} with {len(track_ids)} tracks")
@@ -237,18 +400,26 @@ def update_playlist(sp: spotipy.Spotify, playlist_id: str, track_ids: List[str])
     # Randomize the order of tracks
     random.shuffle(track_ids)
 
-    # Clear the playlist first
-    sp.playlist_replace_items(playlist_id, [])
-    # Spotify API allows up to 100 tracks per request
-    for i in range(0, len(track_ids), 100):
-        batch = track_ids[i:i+100]
+    batches = [track_ids[i:i + PLAYLIST_BATCH_SIZE] for i in range(0, len(track_ids), PLAYLIST_BATCH_SIZE)]
+    # Replacing the items with the first batch clears the playlist in the same request
+    sp.playlist_replace_items(playlist_id, batches[0] if batches else [])
+    if batches:
+        logging.info(f"Added {len(batches[0])} tracks to playlist")
+
+    def add_batch(batch: List[str]) -> None:
+        SPOTIFY_RATE_LIMITER.wait()
         sp.playlist_add_items(playlist_id, batch)
         logging.info(f"Added {len(batch)} tracks to playlist")
-        time.sleep(0.2)  # Sleep to respect API rate limits
+
+    # The order is random anyway, so the remaining batches can be appended concurrently
+    if len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=PLAYLIST_ADD_WORKERS) as executor:
+            list(executor.map(add_batch, batches[1:]))
 
     logging.info("Playlist update completed with randomized order")
 
 def main():
+    lastfm_db = None
     try:
         # Playlist settings
         playlist_name = DEFAULT_PLAYLIST_NAME
@@ -256,7 +427,12 @@ def main():
         track_limit = DEFAULT_TRACK_LIMIT
 
         # Initialize Spotify client
-        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope="playlist-modify-private,playlist-modify-public"))
+        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope="playlist-modify-private,playlist-modify-public",
+                                                       cache_handler=MemoizedCacheFileHandler()))
+        # main.py runs this script alongside album_saver.py, so hold the terminal while
+        # authorizing with Spotify, which may prompt for a login
+        with terminal_lock():
+            sp.auth_manager.get_access_token(as_dict=False)
 
         # Initialize Last.fm database
         lastfm_db = LastFM100DaysDB(LASTFM_100_DAYS_DB)
@@ -270,72 +446,24 @@ def main():
         processed_tracks = process_lastfm_tracks(lastfm_tracks)
 
         # Update database
-        lastfm_db.update_tracks(processed_tracks)
-        lastfm_db.remove_old_tracks(start_date)
+        lastfm_db.replace_tracks(processed_tracks, start_date)
 
         # Get all tracks sorted by play count descending
         all_tracks = lastfm_db.get_all_tracks()
 
-        # Build a dictionary to keep track of the highest play count for each track
-        track_dict = {}
-        for artist, name, album, play_count in all_tracks:
-            key = (artist.lower(), name.lower(), album.lower())
-            if key not in track_dict or play_count > track_dict[key]['play_count']:
-                track_dict[key] = {
-                    'artist': artist,
-                    'name': name,
-                    'album': album,
-                    'play_count': play_count
-                }
-
-        # Get the top tracks based on play count
-        sorted_tracks = sorted(track_dict.values(), key=lambda x: x['play_count'], reverse=True)
-
-        # Build the list of tracks to add to the playlist
-        spotify_track_ids = []
-        track_count = 0
-        for track_info in sorted_tracks:
-            if track_count >= track_limit:
-                break
+        # replace_tracks stored one row per track regardless of case, as aggregated by
+        # process_lastfm_tracks, so the ranked rows need no further deduplication
+        ranked_tracks = ({'artist': artist, 'name': name, 'album': album, 'play_count': play_count}
+                         for artist, name, album, play_count in all_tracks)
 
-            artist = track_info['artist']
-            name = track_info['name']
-            album = track_info['album']
-            play_count = track_info['play_count']
-
-            logging.info(f"Searching for track: {artist} - {name} (Album: {album}, Play count: {play_count})")
-
-            # Search for the track on Spotify using fuzzy matching
-            query = f"track:{name} artist:{artist}"
-            try:
-                results = sp.search(q=query, type='track', limit=10)
-                best_match_id = None
-                highest_score = 0
-                for item in results['tracks']['items']:
-                    spotify_artist = item['artists'][0]['name']
-                    spotify_name = item['name']
-                    spotify_album = item['album']['name']
-                    artist_score = fuzz.token_sort_ratio(artist.lower(), spotify_artist.lower())
-                    name_score = fuzz.token_sort_ratio(name.lower(), spotify_name.lower())
-                    album_score = fuzz.token_sort_ratio(album.lower(), spotify_album.lower())
-                    total_score = (artist_score * 0.3) + (name_score * 0.4) + (album_score * 0.3)
-                    if total_score > highest_score:
-                        highest_score = total_score
-                        best_match_id = item['id']
-                        best_match_info = {
-                            'artist': spotify_artist,
-                            'name': spotify_name,
-                            'album': spotify_album
-                        }
-                if highest_score > 75 and best_match_id:
-                    spotify_track_ids.append(best_match_id)
-                    track_count += 1
-                    logging.info(f"Found match with score {highest_score:.2f}: {best_match_info['artist']} - {best_match_info['name']} (Album: {best_match_info['album']})")
-                else:
-                    logging.warning(f"No suitable match found for: {artist} - {name} (Album: {album})")
-            except Exception as e:
-                logging.error(f"Error searching for track on Spotify: {e}", exc_info=True)
-                continue
+        # Search Spotify concurrently for the top tracks, reusing results cached by earlier runs
+        search_cache = lastfm_db.load_search_cache()
+        cached_keys = set(search_cache)
+        spotify_track_ids = find_spotify_track_ids(sp, ranked_tracks, track_limit, search_cache)
+        # Only write back the results of searches made in this run
+        lastfm_db.save_search_cache({key: track_id for key, track_id in search_cache.items()
+                                     if key not in cached_keys})
+        lastfm_db.close()
 
         # Ensure we only have the desired number of tracks
         spotify_track_ids = spotify_track_ids[:track_limit]
@@ -349,7 +477,7 @@ def main():
         logging.info(f"Playlist '{playlist_name}' updated with {len(spotify_track_ids)} tracks in random order.")
 
         # Get the playlist link
-        playlist_info = sp.playlist(playlist_id)
+        playlist_info = sp.playlist(playlist_id, fields='external_urls')
         playlist_link = playlist_info['external_urls']['spotify']
 
         print(f"\nPlaylist updated successfully!")
@@ -359,6 +487,9 @@ def main():
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}", exc_info=True)
         sys.exit(1)
+    finally:
+        if lastfm_db is not None:
+            lastfm_db.close()
 
 if __name__ == "__main__":
     main()
@@ -4,21 +4,19 @@
 import os
 import sys
 import logging
-import time
 import sqlite3
-import threading
 from datetime import datetime, timezone
-import requests
 from dotenv import load_dotenv
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict
 
 # Modify the sys.path to include the project root
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
 from src.database import Database
+from src.lastfm_operations import iter_recent_track_pages
 from src.spotify_operations import SpotifyOperations
-from src.utils import normalize_string, get_user_input_with_timeout
+from src.utils import get_user_input_with_timeout
 
 # Load environment variables
 load_dotenv()
@@ -28,6 +26,9 @@ LASTFM_API_KEY = os.getenv('LASTFM_API_KEY')
 LASTFM_USER = os.getenv('LASTFM_USER')
 MIN_PLAY_COUNT = int(os.getenv('MIN_PLAY_COUNT', 5))
 
+# Number of scrobbles written to the database per executemany call
+WRITE_BATCH_SIZE = 1000
+
 # Database file paths
 LASTFM_DB_FILE = os.getenv('LASTFM_DB_FILE', 'db/lastfm_history.db')
 SPOTIFY_DB_FILE = os.getenv('SPOTIFY_DB_FILE', 'db/spotify_liked_songs.db')
@@ -45,69 +46,10 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console.setFormatter(formatter)
 logging.getLogger('').addHandler(console)
 
-def get_new_lastfm_tracks(db: Database, from_timestamp: Optional[int] = None) -> int:
-    """
-    Fetch new tracks from Last.fm and update the local database.
-
-    Args:
-        db (Database): The database instance to update.
-        from_timestamp (int, optional): Unix timestamp to fetch tracks from.
-
-    Returns:
-        int: Number of tracks fetched and processed.
-    """
-    url = 'http://ws.audioscrobbler.com/2.0/'
-    params = {
-        'method': 'user.getrecenttracks',
-        'user': LASTFM_USER,
-        'api_key': LASTFM_API_KEY,
-        'format': 'json',
-        'limit': 200,
-    }
-    if from_timestamp:
-        params['from'] = from_timestamp
-        logging.info(f"Fetching tracks from timestamp: {from_timestamp} ({datetime.fromtimestamp(from_timestamp, tz=timezone.utc).isoformat()})")
-    else:
-        logging.info("Fetching all tracks without a 'from' timestamp.")
-
-    all_tracks = []
-    page = 1
-
-    logging.info("Starting to fetch tracks from Last.fm...")
-
-    while True:
-        params['page'] = page
-        try:
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            if 'error' in data:
-                logging.error(f"Error fetching Last.fm tracks: {data['message']}")
-                break
-
-            tracks = data['recenttracks']['track']
-            if not isinstance(tracks, list):
-                tracks = [tracks]
-            all_tracks.extend(tracks)
-
-            total_pages = int(data['recenttracks']['@attr'].get('totalPages', 1))
-            logging.info(f"Fetched page {page} of {total_pages} ({len(tracks)} tracks)")
-
-            if page >= total_pages:
-                break
-            page += 1
-
-        except requests.RequestException as e:
-            logging.error(f"Network error when fetching Last.fm tracks: {e}")
-            time.sleep(5)
-            continue  # Retry on network errors
-        except Exception as e:
-            logging.error(f"Unexpected error in get_new_lastfm_tracks: {e}", exc_info=True)
-            break
-
-    processed_count = 0
-    for track in all_tracks:
+def parse_lastfm_tracks(tracks: List[Dict]) -> List[Dict]:
+    """Convert raw Last.fm track objects into track dicts for Database.add_or_update_tracks."""
+    batch = []
+    for track in tracks:
         try:
             if 'date' in track:
                 track_date = datetime.fromtimestamp(int(track['date']['uts']), tz=timezone.utc)
@@ -118,22 +60,54 @@ def get_new_lastfm_tracks(db: Database, from_timestamp: Optional[int] = None) ->
             album_name = track['album']['#text'] if isinstance(track.get('album'), dict) else track.get('album', '')
             track_name = track['name']
 
-            db.add_or_update_track({
+            batch.append({
                 'artist': artist_name,
                 'name': track_name,
                 'album': album_name,
                 'date': track_date,
                 'mbid': track.get('mbid', '')
             })
-            processed_count += 1
         except Exception as e:
             logging.error(f"Error processing track: {track}", exc_info=True)
             continue
+    return batch
+
+def get_new_lastfm_tracks(db: Database, from_timestamp: Optional[int] = None) -> int:
+    """
+    Fetch new tracks from Last.fm and update the local database.
+
+    Args:
+        db (Database): The database instance to update.
+        from_timestamp (int, optional): Unix timestamp to fetch tracks from.
+
+    Returns:
+        int: Number of tracks fetched and processed.
+    """
+    if from_timestamp:
+        logging.info(f"Fetching tracks from timestamp: {from_timestamp} ({datetime.fromtimestamp(from_timestamp, tz=timezone.utc).isoformat()})")
+    else:
+        logging.info("Fetching all tracks without a 'from' timestamp.")
+
+    def batches():
+        pending = []
+        for page_tracks in iter_recent_track_pages(LASTFM_USER, LASTFM_API_KEY, from_timestamp=from_timestamp):
+            pending.extend(parse_lastfm_tracks(page_tracks))
+            if len(pending) >= WRITE_BATCH_SIZE:
+                yield pending
+                pending = []
+        yield pending
+
+    # Write in batches of several pages while the following pages are still being fetched.
+    # All batches share one transaction, so a page that cannot be fetched rolls back the
+    # whole update instead of leaving a gap that later incremental updates would skip.
+    processed_count = db.add_or_update_track_batches(batches())
 
     logging.info(f"Processed {processed_count} tracks from Last.fm")
     return processed_count
 
 def main():
+    lastfm_db = None
+    spotify_ops = None
     try:
         lastfm_db = Database(db_file=LASTFM_DB_FILE)
         spotify_ops = SpotifyOperations(db_file=SPOTIFY_DB_FILE)
@@ -192,19 +166,18 @@ def main():
         logging.info(f"Found {len(frequently_played)} tracks played more than {MIN_PLAY_COUNT} times on Last.fm")
 
         # Find tracks to be liked
-        tracks_to_like = spotify_ops.find_tracks_to_like(frequently_played, min_play_count=MIN_PLAY_COUNT)
+        tracks_to_like = spotify_ops.find_tracks_to_like(frequently_played, lastfm_db, min_play_count=MIN_PLAY_COUNT)
 
         if tracks_to_like:
             logging.info(f"Found {len(tracks_to_like)} new tracks to like on Spotify:")
+            # Most tracks are cached from their search results; the rest are fetched 50 per request
+            spotify_ops.prefetch_tracks(tracks_to_like)
             for track_id in tracks_to_like:
-                try:
-                    logging.info(f"Fetching track info for track ID: {track_id}")
-                    # Set a timeout for the API call
-                    track_info = spotify_ops.sp.track(track_id)
+                track_info = spotify_ops.get_cached_track(track_id)
+                if track_info:
                     logging.info(f"  - {track_info['artists'][0]['name']} - {track_info['name']}")
-                except Exception as e:
-                    logging.error(f"Error fetching track info for track ID {track_id}: {e}", exc_info=True)
-                    continue
+                else:
+                    logging.info(f"  - Track ID {track_id} (no track info available)")
 
             try:
                 # Like the tracks on Spotify
@@ -229,6 +202,11 @@ def main():
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}", exc_info=True)
         sys.exit(1)
+    finally:
+        if spotify_ops is not None:
+            spotify_ops.close()
+        if lastfm_db is not None:
+            lastfm_db.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
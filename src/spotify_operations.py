@@ -1,27 +1,58 @@
 # spotify_operations.py
 
 import os
-import sys
 import logging
 import time
-import signal
+import threading
 from datetime import datetime, timezone
-import sqlite3
 from dotenv import load_dotenv
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-from rapidfuzz import fuzz
-from src.utils import normalize_string
-from src.database import Database
-from typing import List, Dict, Tuple, Optional, Set, Any, Callable
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from spotipy.cache_handler import CacheFileHandler
+from rapidfuzz import fuzz, process
+from src.utils import normalize_string, sort_tokens, RateLimiter
+from src.database import open_connection, close_connection
+from typing import List, Dict, Optional, Set, Any, Callable, Tuple, Iterator
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
 
 # Use environment variable for database file path
 SPOTIFY_DB_FILE = os.getenv('SPOTIFY_DB_FILE', 'db/spotify_liked_songs.db')
-LASTFM_DB_FILE = os.getenv('LASTFM_DB_FILE', 'db/lastfm_history.db')
+
+# Concurrency and request rate for Spotify track searches
+SEARCH_MAX_WORKERS = 8
+SEARCH_RATE_LIMIT = 10  # requests per second
+
+# Format of the added_at timestamps returned by the Spotify library endpoints
+SPOTIFY_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Fuzzy matching of Spotify search results
+MATCH_THRESHOLD = 80  # minimum average of the name (or album) and artist scores
+MATCH_SCORE_CUTOFF = 2 * MATCH_THRESHOLD - 100  # lowest single score that can still reach the threshold
+
+class MemoizedCacheFileHandler(CacheFileHandler):
+    """
+    Token cache file handler that keeps the token in memory after the first read.
+
+    SpotifyOAuth asks its cache handler for the token before every API request; the
+    plain CacheFileHandler re-reads and parses the cache file each time. Refreshed
+    tokens are still written through to the file.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_info: Optional[dict] = None
+
+    def get_cached_token(self) -> Optional[dict]:
+        if self._token_info is None:
+            self._token_info = super().get_cached_token()
+        return self._token_info
+
+    def save_token_to_cache(self, token_info: dict) -> None:
+        self._token_info = token_info
+        super().save_token_to_cache(token_info)
 
 class TimeoutException(Exception):
     pass
@@ -35,20 +66,35 @@ class SpotifyOperations:
     def __init__(self, db_file=SPOTIFY_DB_FILE):
         """Initialize the Spotify operations and create necessary database tables."""
         self.sp = spotipy.Spotify(
-            auth_manager=SpotifyOAuth(scope="user-library-read user-library-modify"),
+            auth_manager=SpotifyOAuth(scope="user-library-read user-library-modify",
+                                      cache_handler=MemoizedCacheFileHandler()),
             requests_timeout=10  # Set a timeout of 10 seconds
         )
         self.db_file = db_file
+        # Long-lived connections keep SQLite's page and statement caches warm between calls
+        self.conn = open_connection(self.db_file)
+        self._db_lock = threading.Lock()  # Guards self.conn when searching from worker threads
+        self.search_rate_limiter = RateLimiter(SEARCH_RATE_LIMIT, burst=SEARCH_MAX_WORKERS)
+        self._track_cache: Dict[str, dict] = {}  # track_id -> full track object from search or sp.tracks()
+        self._search_cache: Dict[Tuple[str, str], Optional[str]] = {}  # (name, artist) -> search_cache.track_id, None if absent
+        self._pending_search_cache: List[Tuple[str, str, str]] = []  # search_cache rows not yet written
+        self._liked_keys: Set[Tuple[str, str]] = set()  # (name, artist) pairs known to be in liked_songs
         self.create_tables()
 
+    def close(self):
+        """Close the database connection."""
+        self.flush_search_cache()
+        close_connection(self.conn)
+
     def create_tables(self):
         """Create necessary tables in the database if they don't exist."""
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         
         # Create the liked_songs table if it doesn't exist
         c.execute('''CREATE TABLE IF NOT EXISTS liked_songs
                      (id TEXT PRIMARY KEY, name TEXT, artist TEXT, album TEXT, album_id TEXT, added_at TEXT)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_liked_name_artist ON liked_songs (name, artist)''')
         
         # Create metadata table if it doesn't exist
         c.execute('''CREATE TABLE IF NOT EXISTS metadata
@@ -68,44 +114,36 @@ class SpotifyOperations:
                      (id TEXT PRIMARY KEY, name TEXT, artist TEXT, added_at TEXT)''')
         
         conn.commit()
-        conn.close()
-
-    def fetch_all_liked_songs(self):
-        offset = 0
-        limit = 50
-        all_tracks = []
-
-        while True:
-            results = self.sp.current_user_saved_tracks(limit=limit, offset=offset)
-            tracks = results['items']
-            if len(tracks) == 0:
-                break
-            all_tracks.extend(tracks)
-            offset += limit
-
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-
-        for item in all_tracks:
-            track = item['track']
-            name = normalize_string(track['name'])
-            artist = normalize_string(track['artists'][0]['name'])
-            album = normalize_string(track['album']['name'])
-            album_id = track['album']['id']
-            c.execute("INSERT OR REPLACE INTO liked_songs VALUES (?, ?, ?, ?, ?, ?)",
-                      (track['id'], name, artist, album, album_id, item['added_at']))
 
-        conn.commit()
-        conn.close()
+    def _iter_pages(self, fetch_page: Callable, limit: int = 50, max_workers: int = 5) -> Iterator[List[dict]]:
+        """Yield the items of every page of a paginated Spotify endpoint, requesting pages after the first concurrently."""
+        first_page = self.api_call_with_retry(fetch_page, limit=limit, offset=0)
+        yield first_page['items']
+        total = first_page.get('total') or 0
+        offsets = range(limit, total, limit)
+        if offsets:
+            # Pages come back in offset order, so items keep Spotify's ordering
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pages = executor.map(
+                    lambda offset: self.api_call_with_retry(fetch_page, limit=limit, offset=offset),
+                    offsets
+                )
+                for page in pages:
+                    yield page['items']
 
-        return len(all_tracks)
+    def fetch_all_liked_songs(self):
+        # Store each page as it arrives instead of holding the whole library in memory
+        total_tracks = 0
+        for tracks in self._iter_pages(self.sp.current_user_saved_tracks):
+            self._save_tracks_to_db(tracks)
+            total_tracks += len(tracks)
+        return total_tracks
 
     def get_liked_songs_set(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT name, artist FROM liked_songs")
         liked_songs = c.fetchall()
-        conn.close()
         
         # Check for duplicates
         liked_set = set()
@@ -125,7 +163,7 @@ class SpotifyOperations:
         return liked_set
 
     def remove_duplicates(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("""
             DELETE FROM liked_songs
@@ -137,7 +175,6 @@ class SpotifyOperations:
         """)
         removed = c.rowcount
         conn.commit()
-        conn.close()
         logging.info(f"Removed {removed} duplicate entries from liked_songs table")
 
     def like_tracks(self, track_ids):
@@ -156,49 +193,86 @@ class SpotifyOperations:
                 except spotipy.exceptions.SpotifyException as e:
                     logging.error(f"Error liking tracks (attempt {attempt + 1}/{max_retries}): {e}")
                     if attempt < max_retries - 1:
-                        time.sleep(2 ** attempt)  # Exponential backoff
+                        time.sleep(self._retry_delay(e, attempt))
                     else:
                         logging.error(f"Failed to like tracks after {max_retries} attempts")
                 except Exception as e:
                     logging.error(f"Unexpected error liking tracks: {e}", exc_info=True)
                     break  # Exit retry loop for unexpected errors
-            time.sleep(0.1)  # Add a small delay to avoid rate limiting
 
-    def _save_newly_liked_tracks(self, track_ids):
-        # Fetch details of the newly liked tracks in batches
-        batch_size = 50
-        tracks = []
-        for i in range(0, len(track_ids), batch_size):
-            batch = track_ids[i:i+batch_size]
-            response = self.sp.tracks(batch)
+    @staticmethod
+    def _retry_delay(error: spotipy.exceptions.SpotifyException, attempt: int) -> float:
+        """Seconds to wait before retrying a failed Spotify call: Retry-After on 429, else exponential backoff."""
+        if error.http_status == 429:
+            retry_after = (error.headers or {}).get('Retry-After')
+            if retry_after:
+                return float(retry_after)
+        return 2 ** attempt
+
+    def prefetch_tracks(self, track_ids: List[str]) -> None:
+        """
+        Fetch track details in batches of 50 via sp.tracks() for tracks not already cached.
+
+        A batch that fails is logged and skipped, so its tracks are simply missing from the cache.
+        """
+        batch_size = 50  # Spotify allows up to 50 tracks per request
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in self._track_cache]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i+batch_size]
+            try:
+                response = self.sp.tracks(batch)
+            except Exception as e:
+                logging.error(f"Error fetching track info for {len(batch)} track IDs: {e}", exc_info=True)
+                continue
             for track in response['tracks']:
-                tracks.append({
-                    'added_at': datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(),
-                    'track': track
-                })
-            time.sleep(0.1)  # To respect rate limits
+                if track:
+                    self._track_cache[track['id']] = track
 
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
+    def get_cached_track(self, track_id: str) -> Optional[dict]:
+        """Return the full track object cached by a search or prefetch_tracks, if any."""
+        return self._track_cache.get(track_id)
+
+    def _save_newly_liked_tracks(self, track_ids):
+        # Fetch details of the newly liked tracks in batches, skipping those already seen in search results
+        self.prefetch_tracks(track_ids)
+        # Fetch any track whose batch failed or came back empty on its own, so a track
+        # liked on Spotify is not silently left out of liked_songs
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in self._track_cache]
+        for track_id in missing:
+            try:
+                track = self.sp.track(track_id)
+            except Exception as e:
+                logging.error(f"Error fetching track info for track ID {track_id}: {e}", exc_info=True)
+                continue
+            if track:
+                self._track_cache[track_id] = track
+        not_saved = [track_id for track_id in missing if track_id not in self._track_cache]
+        if not_saved:
+            logging.warning(f"No track info for {len(not_saved)} liked tracks, not saved to local database: {', '.join(not_saved)}")
+        added_at = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
+        tracks = [{'added_at': added_at, 'track': self._track_cache[track_id]}
+                  for track_id in track_ids if track_id in self._track_cache]
+
+        # Normalize and filter before opening the write transaction so it only covers the insert
+        rows = []
+        seen = set()
         for item in tracks:
             track = item['track']
             name = normalize_string(track['name'])
             artist = normalize_string(track['artists'][0]['name'])
             album = normalize_string(track['album']['name'])
             album_id = track['album']['id']
-            
+
             # Check if the track already exists
-            c.execute("SELECT id FROM liked_songs WHERE name = ? AND artist = ?", (name, artist))
-            existing = c.fetchone()
-            if existing:
+            if (name, artist) in seen or self.is_liked(name, artist):
                 logging.info(f"Track already in database: {artist} - {name}")
             else:
-                c.execute("INSERT INTO liked_songs VALUES (?, ?, ?, ?, ?, ?)",
-                          (track['id'], name, artist, album, album_id, item['added_at']))
+                seen.add((name, artist))
+                rows.append((track['id'], name, artist, album, album_id, item['added_at']))
                 logging.info(f"Saving newly liked track: {artist} - {name}")
-        
-        conn.commit()
-        conn.close()
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO liked_songs VALUES (?, ?, ?, ?, ?, ?)", rows)
 
     def search_track(self, name, artist):
         """Search for a track on Spotify and return its ID if found."""
@@ -214,9 +288,13 @@ class SpotifyOperations:
             f"{name} {artist}"
         ]
 
+        # Token-sort the probe once instead of per query variation and candidate
+        name_key = sort_tokens(name)
+        artist_key = sort_tokens(artist)
+
         for query in queries:
             try:
-                track_id = self._search_and_match(query, name, artist)
+                track_id = self._search_and_match(query, name_key, artist_key)
                 if track_id:
                     self.cache_track_id(name, artist, track_id)
                     return track_id
@@ -229,145 +307,240 @@ class SpotifyOperations:
         self.cache_track_id(name, artist, None)
         return None
 
-    def _search_and_match(self, query, name, artist):
-        """Perform a search query and match results against the given name and artist."""
+    def _search_and_match(self, query, name_key, artist_key):
+        """Perform a search query and match results against the token-sorted name and artist."""
         max_retries = 3
         for attempt in range(max_retries):
             try:
+                self.search_rate_limiter.wait()  # Shared across search threads to respect rate limits
                 results = self.sp.search(q=query, type='track', limit=10)
-                if results['tracks']['items']:
+                items = results['tracks']['items']
+                if items:
+                    # fuzz.ratio on token-sorted strings is fuzz.token_sort_ratio without re-sorting the probe
+                    spotify_names = [sort_tokens(normalize_string(item['name'])) for item in items]
+                    # The average can only pass the threshold if both scores are at least
+                    # MATCH_SCORE_CUTOFF, so weaker candidates are dropped inside rapidfuzz
+                    name_scores = {index: score for _, score, index in process.extract(
+                        name_key, spotify_names, scorer=fuzz.ratio, processor=None,
+                        limit=None, score_cutoff=MATCH_SCORE_CUTOFF)}
+                    # Only candidates whose name survived the cutoff need an artist score
+                    spotify_artists = {index: sort_tokens(normalize_string(items[index]['artists'][0]['name']))
+                                       for index in name_scores}
+                    artist_scores = {index: score for _, score, index in process.extract(
+                        artist_key, spotify_artists, scorer=fuzz.ratio, processor=None,
+                        limit=None, score_cutoff=MATCH_SCORE_CUTOFF)}
                     best_match = None
                     highest_score = 0
-                    for item in results['tracks']['items']:
-                        spotify_name = normalize_string(item['name'])
-                        spotify_artist = normalize_string(item['artists'][0]['name'])
-                        name_score = fuzz.token_sort_ratio(name, spotify_name)
-                        artist_score = fuzz.token_sort_ratio(artist, spotify_artist)
-                        total_score = (name_score + artist_score) / 2
+                    for index in sorted(artist_scores):
+                        total_score = (name_scores[index] + artist_scores[index]) / 2
                         if total_score > highest_score:
                             highest_score = total_score
-                            best_match = item['id']
-                    if highest_score > 80:  # Threshold can be adjusted
-                        return best_match
+                            best_match = items[index]
+                            if total_score == 100:
+                                break  # Nothing later can score higher
+                    if highest_score > MATCH_THRESHOLD:  # Threshold can be adjusted
+                        # Keep the full track object so liking it later needs no sp.tracks() lookup
+                        self._track_cache[best_match['id']] = best_match
+                        return best_match['id']
                 return None
             except spotipy.exceptions.SpotifyException as e:
                 logging.error(f"Spotify API error during search (attempt {attempt + 1}/{max_retries}): {e}")
                 if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
+                    time.sleep(self._retry_delay(e, attempt))
                 else:
                     logging.error(f"Failed to search after {max_retries} attempts")
             except Exception as e:
                 logging.error(f"Unexpected error during search: {e}", exc_info=True)
                 break  # Exit retry loop for unexpected errors
-            finally:
-                time.sleep(0.1)  # Small delay to respect rate limits
         return None
 
     def get_cached_track_id(self, name, artist):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        c.execute("SELECT track_id FROM search_cache WHERE name = ? AND artist = ?", (name, artist))
-        result = c.fetchone()
-        conn.close()
-        if result:
-            return result[0] if result[0] != 'NOT_FOUND' else None
-        return None
+        key = (name, artist)
+        with self._db_lock:
+            if key in self._search_cache:
+                track_id = self._search_cache[key]
+            else:
+                c = self.conn.cursor()
+                c.execute("SELECT track_id FROM search_cache WHERE name = ? AND artist = ?", (name, artist))
+                result = c.fetchone()
+                track_id = self._search_cache[key] = result[0] if result else None
+        return track_id if track_id != 'NOT_FOUND' else None
+
+    def prefill_search_cache(self, pairs):
+        """Load search_cache rows for many (name, artist) pairs at once so searches skip per-track SELECTs."""
+        pairs = [pair for pair in dict.fromkeys(pairs) if pair not in self._search_cache]
+        # Two bound parameters per pair, kept under SQLite's historical limit of 999
+        pairs_per_query = 999 // 2
+        found = {}
+        for i in range(0, len(pairs), pairs_per_query):
+            batch = pairs[i:i+pairs_per_query]
+            placeholders = ', '.join(['(?, ?)'] * len(batch))
+            rows = self.conn.execute(
+                f"SELECT name, artist, track_id FROM search_cache WHERE (name, artist) IN (VALUES {placeholders})",
+                [value for pair in batch for value in pair]
+            ).fetchall()
+            found.update(((name, artist), track_id) for name, artist, track_id in rows)
+        with self._db_lock:
+            for pair in pairs:
+                self._search_cache.setdefault(pair, found.get(pair))
 
     def cache_track_id(self, name, artist, track_id):
         if track_id is None:
             track_id = 'NOT_FOUND'
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        c.execute("INSERT OR REPLACE INTO search_cache (name, artist, track_id) VALUES (?, ?, ?)",
-                  (name, artist, track_id))
-        conn.commit()
-        conn.close()
+        # Search threads only queue the write; flush_search_cache stores the batch in one transaction
+        with self._db_lock:
+            self._search_cache[(name, artist)] = track_id
+            self._pending_search_cache.append((name, artist, track_id))
+
+    def flush_search_cache(self):
+        """Write search results queued by cache_track_id to the search_cache table."""
+        with self._db_lock:
+            rows, self._pending_search_cache = self._pending_search_cache, []
+            if rows:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO search_cache (name, artist, track_id) VALUES (?, ?, ?)", rows
+                    )
 
-    def find_tracks_to_like(self, lastfm_tracks, min_play_count=5):
+    def find_tracks_to_like(self, lastfm_tracks, lastfm_db, min_play_count=5):
         spotify_liked = self.get_liked_songs_set()
+        liked_by_length = self.index_by_name_length(spotify_liked)
         tracks_to_like = []
         processed_tracks = []
+        tracks_to_search = []
+        seen = set()
 
         for track in lastfm_tracks:
             if track[2] >= min_play_count:
                 name, artist, play_count = track[1], track[0], track[2]
+                # Never check or search the same track twice
+                if (artist, name) in seen:
+                    continue
+                seen.add((artist, name))
                 processed_tracks.append((artist, name, play_count))
 
                 logging.info(f"Checking track: {artist} - {name} (Play count: {play_count})")
 
-                if not self.is_track_liked(name, artist, spotify_liked):
+                if not self.is_track_liked(name, artist, spotify_liked, liked_by_length):
                     logging.info(f"Track not liked on Spotify: {artist} - {name}")
-                    track_id = self.search_track(name, artist)
-                    if track_id:
-                        if not self.is_track_in_database(track_id):
-                            tracks_to_like.append(track_id)
-                            logging.info(f"Will like: {artist} - {name}")
-                        else:
-                            logging.info(f"Track already in database, skipping: {artist} - {name}")
-                    else:
-                        logging.info(f"Couldn't find track on Spotify: {artist} - {name}")
-                        self.add_unfound_track(artist, name)
+                    tracks_to_search.append((artist, name))
                 else:
                     logging.info(f"Track already liked, skipping: {artist} - {name}")
             else:
                 logging.info(f"Skipping track with low play count: {track[0]} - {track[1]} (Play count: {track[2]})")
                 break
 
-        # Mark processed tracks in the Last.fm database
-        lastfm_db = Database(db_file=LASTFM_DB_FILE)
+        # Searches are network-bound, so run them concurrently; results come back in order
+        self.prefill_search_cache([(name, artist) for artist, name in tracks_to_search])
+
+        unfound_tracks = []
+        queued_ids = set()
+        with ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS) as executor:
+            track_ids = executor.map(lambda track: self.search_track(track[1], track[0]), tracks_to_search)
+            for (artist, name), track_id in zip(tracks_to_search, track_ids):
+                if track_id:
+                    if track_id in queued_ids:
+                        logging.info(f"Track already queued to like, skipping: {artist} - {name}")
+                    elif not self.is_track_in_database(track_id):
+                        tracks_to_like.append(track_id)
+                        queued_ids.add(track_id)
+                        logging.info(f"Will like: {artist} - {name}")
+                    else:
+                        logging.info(f"Track already in database, skipping: {artist} - {name}")
+                else:
+                    logging.info(f"Couldn't find track on Spotify: {artist} - {name}")
+                    unfound_tracks.append((artist, name))
+
+        # Write the search results in two batches rather than one commit per search
+        self.flush_search_cache()
+        self.add_unfound_tracks(unfound_tracks)
+
+        # Mark processed tracks in the Last.fm database, through the caller's connection
         lastfm_db.mark_tracks_as_processed(processed_tracks)
 
         logging.info(f"Found {len(processed_tracks)} tracks with {min_play_count}+ plays on Last.fm")
         logging.info(f"Of these, {len(tracks_to_like)} are new tracks to like on Spotify")
         return tracks_to_like
 
-    def is_track_liked(self, name, artist, spotify_liked):
+    @staticmethod
+    def index_by_name_length(spotify_liked):
+        """Group liked (name, artist) pairs by the length of the name."""
+        liked_by_length = {}
+        for liked_name, liked_artist in spotify_liked:
+            liked_by_length.setdefault(len(liked_name), []).append((liked_name, liked_artist))
+        return liked_by_length
+
+    def is_track_liked(self, name, artist, spotify_liked, liked_by_length=None):
         normalized_name = normalize_string(name)
         normalized_artist = normalize_string(artist)
-        return any(
-            fuzz.ratio(normalized_name, liked_name) > 90 and
-            fuzz.ratio(normalized_artist, liked_artist) > 90
-            for liked_name, liked_artist in spotify_liked
-        )
+        # Exact matches need no fuzzy scoring
+        if (normalized_name, normalized_artist) in spotify_liked:
+            return True
+        if liked_by_length is None:
+            liked_by_length = self.index_by_name_length(spotify_liked)
+        # fuzz.ratio(a, b) > 90 is impossible unless 9/11 < len(b)/len(a) < 11/9,
+        # so only names within that length band need to be scored
+        name_length = len(normalized_name)
+        for length in range(name_length * 9 // 11, name_length * 11 // 9 + 1):
+            for liked_name, liked_artist in liked_by_length.get(length, ()):
+                if (fuzz.ratio(normalized_name, liked_name, score_cutoff=90) > 90 and
+                        fuzz.ratio(normalized_artist, liked_artist, score_cutoff=90) > 90):
+                    return True
+        return False
+
+    def is_liked(self, name, artist):
+        """Check for an exact (normalized) name and artist match in liked_songs using its index."""
+        # Rows are only ever removed as duplicates, so a pair once seen stays liked
+        if (name, artist) in self._liked_keys:
+            return True
+        result = self.conn.execute(
+            "SELECT 1 FROM liked_songs WHERE name = ? AND artist = ? LIMIT 1", (name, artist)
+        ).fetchone()
+        if result is None:
+            return False
+        self._liked_keys.add((name, artist))
+        return True
 
     def is_track_in_database(self, track_id):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        c.execute("SELECT id FROM liked_songs WHERE id = ?", (track_id,))
-        result = c.fetchone()
-        conn.close()
+        with self._db_lock:
+            conn = self.conn
+            c = conn.cursor()
+            c.execute("SELECT id FROM liked_songs WHERE id = ?", (track_id,))
+            result = c.fetchone()
         return result is not None
 
     def add_unfound_track(self, artist, name):
         """Add a track that couldn't be found on Spotify to the unfound_tracks table."""
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO unfound_tracks (artist, name) VALUES (?, ?)", (artist, name))
-        conn.commit()
-        conn.close()
+        self.add_unfound_tracks([(artist, name)])
+
+    def add_unfound_tracks(self, tracks):
+        """Add (artist, name) pairs that couldn't be found on Spotify to the unfound_tracks table."""
+        with self._db_lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO unfound_tracks (artist, name) VALUES (?, ?)", tracks)
 
     def get_last_update_time(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT value FROM metadata WHERE key = 'last_update'")
         result = c.fetchone()
-        conn.close()
         if result and result[0]:
             # Ensure the datetime is timezone-aware and in UTC
             return datetime.fromisoformat(result[0]).astimezone(timezone.utc)
         return None
 
     def set_last_update_time(self, update_time):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         # Ensure update_time is in ISO format with timezone info
         c.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
                   ('last_update', update_time.astimezone(timezone.utc).isoformat()))
         conn.commit()
-        conn.close()
 
     def fetch_new_liked_songs(self):
         last_update = self.get_last_update_time()
+        # added_at is ISO-8601 UTC with whole seconds, so it can be compared as a string
+        last_update_iso = last_update.strftime(SPOTIFY_TIMESTAMP_FORMAT) if last_update else None
         offset = 0
         limit = 50
         new_tracks = []
@@ -379,17 +552,20 @@ class SpotifyOperations:
         while iterations < max_iterations:
             try:
                 results = self.sp.current_user_saved_tracks(limit=limit, offset=offset)
-                if not results['items']:
+                items = results['items']
+                if not items:
                     break
-                for item in results['items']:
-                    added_at = datetime.strptime(item['added_at'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-                    if last_update and added_at <= last_update:
-                        logging.info("Reached tracks already in local database.")
-                        return new_tracks
-                    new_tracks.append(item)
+                # Pages are newest-first, so if the oldest item is new the whole page is
+                if not last_update_iso or items[-1]['added_at'] > last_update_iso:
+                    new_tracks.extend(items)
+                else:
+                    for item in items:
+                        if item['added_at'] <= last_update_iso:
+                            logging.info("Reached tracks already in local database.")
+                            return new_tracks
+                        new_tracks.append(item)
                 offset += limit
                 iterations += 1
-                time.sleep(0.1)  # Small delay to respect rate limits
             except Exception as e:
                 logging.error(f"Error fetching liked songs: {e}", exc_info=True)
                 break
@@ -405,13 +581,10 @@ class SpotifyOperations:
             logging.info(f"Fetched {total_tracks} liked songs from Spotify.")
             self.set_last_update_time(datetime.utcnow().replace(tzinfo=timezone.utc))
             
-            # Add logging to verify database update
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM liked_songs")
-            total_liked_songs = c.fetchone()[0]
-            conn.close()
-            logging.info(f"Total liked songs in local database: {total_liked_songs}")
+            # Verifying the update costs a full COUNT(*), so only do it when debugging
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                total_liked_songs = self.conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
+                logging.debug(f"Total liked songs in local database: {total_liked_songs}")
             
             return total_tracks
         else:
@@ -421,39 +594,33 @@ class SpotifyOperations:
                 return 0
             self._save_tracks_to_db(new_tracks)
             if new_tracks:
-                latest_added_at = max(
-                    datetime.strptime(item['added_at'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-                    for item in new_tracks
-                )
+                latest_added_at = datetime.strptime(
+                    max(item['added_at'] for item in new_tracks), SPOTIFY_TIMESTAMP_FORMAT
+                ).replace(tzinfo=timezone.utc)
                 self.set_last_update_time(latest_added_at)
                 logging.info(f"Updated last update time to: {latest_added_at.isoformat()}")
             
-            # Add logging to verify database update
-            conn = sqlite3.connect(self.db_file)
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM liked_songs")
-            total_liked_songs = c.fetchone()[0]
-            conn.close()
-            logging.info(f"Total liked songs in local database after update: {total_liked_songs}")
+            # Verifying the update costs a full COUNT(*), so only do it when debugging
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                total_liked_songs = self.conn.execute("SELECT COUNT(*) FROM liked_songs").fetchone()[0]
+                logging.debug(f"Total liked songs in local database after update: {total_liked_songs}")
             
             return len(new_tracks)
 
     def _save_tracks_to_db(self, tracks):
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
+        rows = []
         for item in tracks:
             track = item['track']
             name = normalize_string(track['name'])
             artist = normalize_string(track['artists'][0]['name'])
             album = normalize_string(track['album']['name'])
             album_id = track['album']['id']
-            c.execute("INSERT OR REPLACE INTO liked_songs VALUES (?, ?, ?, ?, ?, ?)",
-                      (track['id'], name, artist, album, album_id, item['added_at']))
-        conn.commit()
-        conn.close()
+            rows.append((track['id'], name, artist, album, album_id, item['added_at']))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO liked_songs VALUES (?, ?, ?, ?, ?, ?)", rows)
 
     def verify_local_database(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT COUNT(*) FROM liked_songs")
         count = c.fetchone()[0]
@@ -461,33 +628,29 @@ class SpotifyOperations:
         c.execute("SELECT name, artist FROM liked_songs LIMIT 5")
         sample = c.fetchall()
         logging.info(f"Sample of liked songs in database: {sample}")
-        conn.close()
 
     def log_unfound_tracks(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT artist, name FROM unfound_tracks")
         unfound = c.fetchall()
-        conn.close()
         logging.info(f"Unfound tracks in database: {len(unfound)}")
         for artist, name in unfound[:5]:  # Log first 5 for brevity
             logging.info(f"Unfound: {artist} - {name}")
 
     def get_all_album_ids(self):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT DISTINCT album_id FROM liked_songs")
         album_ids = [row[0] for row in c.fetchall()]
-        conn.close()
         return album_ids
 
     def get_album_ids_since(self, since_datetime):
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT DISTINCT album_id FROM liked_songs WHERE added_at > ?",
                   (since_datetime.isoformat(),))
         album_ids = [row[0] for row in c.fetchall()]
-        conn.close()
         return album_ids
 
     def search_album(self, album_name: str, artist_name: str) -> Optional[str]:
@@ -499,21 +662,32 @@ class SpotifyOperations:
         query = f"album:{normalized_album} artist:{normalized_artist}"
         logging.info(f"Searching for album on Spotify: {artist_name} - {album_name}")
         try:
+            self.search_rate_limiter.wait()  # Album searches may also run from worker threads
             results = self.sp.search(q=query, type='album', limit=5)
             if results['albums']['items']:
-                # Use fuzzy matching to find the best match
+                # Use fuzzy matching to find the best match; fuzz.ratio on token-sorted strings
+                # is fuzz.token_sort_ratio without re-sorting the probe for every candidate
+                album_key = sort_tokens(normalized_album)
+                artist_key = sort_tokens(normalized_artist)
                 best_match_id = None
                 highest_score = 0
                 for item in results['albums']['items']:
-                    spotify_album = normalize_string(item['name'])
-                    spotify_artist = normalize_string(item['artists'][0]['name'])
-                    album_score = fuzz.token_sort_ratio(normalized_album, spotify_album)
-                    artist_score = fuzz.token_sort_ratio(normalized_artist, spotify_artist)
+                    # Below its cutoff a score is returned as 0, and the average can no longer pass
+                    album_score = fuzz.ratio(album_key, sort_tokens(normalize_string(item['name'])),
+                                             processor=None, score_cutoff=MATCH_SCORE_CUTOFF)
+                    if not album_score:
+                        continue
+                    artist_score = fuzz.ratio(artist_key, sort_tokens(normalize_string(item['artists'][0]['name'])),
+                                              processor=None, score_cutoff=2 * MATCH_THRESHOLD - album_score)
+                    if not artist_score:
+                        continue
                     total_score = (album_score + artist_score) / 2
                     if total_score > highest_score:
                         highest_score = total_score
                         best_match_id = item['id']
-                if highest_score > 80:
+                        if total_score == 100:
+                            break
+                if highest_score > MATCH_THRESHOLD:
                     logging.info(f"Found album on Spotify with score {highest_score}: ID {best_match_id}")
                     return best_match_id
                 else:
@@ -524,47 +698,12 @@ class SpotifyOperations:
             logging.error(f"Error searching for album: {e}", exc_info=True)
         return None
 
-    def fetch_all_saved_albums(self):
-        """Fetch all saved albums from Spotify and store them in the local database."""
-        offset = 0
-        limit = 50
-        all_albums = []
-
-        logging.info("Fetching saved albums from Spotify...")
-        while True:
-            results = self.sp.current_user_saved_albums(limit=limit, offset=offset)
-            albums = results['items']
-            if not albums:
-                break
-            all_albums.extend(albums)
-            offset += limit
-            time.sleep(0.1)  # Respect rate limits
-
-        conn = sqlite3.connect(self.db_file)
-        c = conn.cursor()
-
-        for item in all_albums:
-            album = item['album']
-            name = normalize_string(album['name'])
-            artist = normalize_string(album['artists'][0]['name'])
-            album_id = album['id']
-            added_at = item['added_at']
-            c.execute("INSERT OR REPLACE INTO saved_albums VALUES (?, ?, ?, ?)",
-                      (album_id, name, artist, added_at))
-
-        conn.commit()
-        conn.close()
-
-        logging.info(f"Fetched and stored {len(all_albums)} saved albums.")
-        return len(all_albums)
-
     def get_saved_albums_set(self) -> Set[str]:
         """Retrieve set of album IDs that are saved in the local database."""
-        conn = sqlite3.connect(self.db_file)
+        conn = self.conn
         c = conn.cursor()
         c.execute("SELECT id FROM saved_albums")
         saved_albums = set(row[0] for row in c.fetchall())
-        conn.close()
         logging.info(f"Retrieved {len(saved_albums)} saved albums from local database.")
         return saved_albums
 
@@ -581,12 +720,11 @@ class SpotifyOperations:
             added_at = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
 
             # Update local database
-            conn = sqlite3.connect(self.db_file)
+            conn = self.conn
             c = conn.cursor()
             c.execute("INSERT OR REPLACE INTO saved_albums VALUES (?, ?, ?, ?)",
                       (album_id, name, artist, added_at))
             conn.commit()
-            conn.close()
             logging.info(f"Updated local database with album: {artist} - {name}")
 
         except Exception as e:
@@ -598,88 +736,13 @@ class SpotifyOperations:
                 return func(*args, **kwargs)
             except Exception as e:
                 if attempt < max_retries - 1:
-                    logging.warning(f"API call failed, retrying in {1 + attempt} seconds...")
-                    time.sleep(1 + attempt)  # Shorter wait times
+                    # Wait as long as Spotify asks when rate limited
+                    if isinstance(e, spotipy.exceptions.SpotifyException) and e.http_status == 429:
+                        delay = self._retry_delay(e, attempt)
+                    else:
+                        delay = 1 + attempt  # Shorter wait times
+                    logging.warning(f"API call failed, retrying in {delay} seconds...")
+                    time.sleep(delay)
                 else:
                     logging.error(f"API call failed after {max_retries} attempts: {e}", exc_info=True)
-                    raise
-
-    def check_album_conditions(self, album_id: str) -> bool:
-        """Check if an album meets the criteria to be saved."""
-        logging.info(f"Starting to check album conditions for album_id: {album_id}")
-        try:
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(self.api_call_with_retry, self.sp.album, album_id)
-                try:
-                    album = future.result(timeout=30)  # Increased from 10 to 30 seconds
-                except TimeoutError:
-                    logging.error(f"TimeoutError: Fetching album details for album_id {album_id} took too long.")
-                    return False
-
-            album_name = album['name']
-            artist_name = album['artists'][0]['name']
-
-            if 'various artists' in artist_name.lower():
-                return False
-
-            album_tracks = self.get_album_tracks(album_id)
-            total_tracks = len(album_tracks)
-
-            if total_tracks <= 6:
-                return False
-
-            listened_tracks = 0
-            tracks_listened_3_times = 0
-
-            conn = sqlite3.connect(LASTFM_DB_FILE)
-            c = conn.cursor()
-            try:
-                for track in album_tracks:
-                    normalized_track = normalize_string(track['name'])
-                    normalized_artist = normalize_string(artist_name)
-                    c.execute(
-                        "SELECT listen_count FROM tracks WHERE name = ? AND artist = ?",
-                        (normalized_track, normalized_artist)
-                    )
-                    result = c.fetchone()
-                    listen_count = result[0] if result else 0
-                    if listen_count > 0:
-                        listened_tracks += 1
-                    if listen_count >= 3:
-                        tracks_listened_3_times += 1
-            finally:
-                conn.close()
-
-            condition1 = listened_tracks >= 0.75 * total_tracks
-            condition2 = tracks_listened_3_times >= 3
-
-            return condition1 or condition2
-        except Exception as e:
-            logging.error(f"Error in check_album_conditions for album_id {album_id}: {e}", exc_info=True)
-            return False
-
-    def get_album_tracks(self, album_id: str) -> List[dict]:
-        """Retrieve all tracks from an album."""
-        tracks = []
-        try:
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(self.api_call_with_retry, self.sp.album_tracks, album_id)
-                try:
-                    results = future.result(timeout=30)  # Increased from 10 to 30 seconds
-                except TimeoutError:
-                    logging.error(f"TimeoutError: Fetching album tracks for album_id {album_id} took too long.")
-                    return []
-
-            tracks.extend(results['items'])
-            while results['next']:
-                with ThreadPoolExecutor(max_workers=1) as executor:
-                    future = executor.submit(self.api_call_with_retry, self.sp.next, results)
-                    try:
-                        results = future.result(timeout=30)  # Increased from 10 to 30 seconds
-                    except TimeoutError:
-                        logging.error(f"TimeoutError: Fetching next page of tracks for album_id {album_id} took too long.")
-                        break
-                tracks.extend(results['items'])
-        except Exception as e:
-            logging.error(f"Error fetching tracks for album {album_id}: {e}", exc_info=True)
-        return tracks
\ No newline at end of file
+                    raise
\ No newline at end of file
@@ -1,23 +1,61 @@
 # utils.py
 
+import os
 import re
+import tempfile
 import threading
 import sys
 import time
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timezone
+from typing import Iterable, Iterator, List
 
+# fcntl is POSIX only; elsewhere terminal_lock does not lock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Shared by every script, so scripts that main.py runs in parallel take turns at the terminal
+TERMINAL_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'lastfm-spotify-liker-terminal.lock')
+
+# Distinct strings remembered by normalize_string and sort_tokens; artist and
+# album names repeat across a whole Last.fm history, so hits are the common case
+STRING_CACHE_SIZE = 65536
+
+# Patterns used by normalize_string, compiled once at import time
+_BRACKETED_RE = re.compile(r'\s*[\(\[\{].*?[\)\]\}]')
+_KEYWORD_RE = re.compile(r'\b(remastered|live|acoustic|mono|stereo|version|edit|feat\.?|featuring|from|remix)\b(\s+\d{4})?')
+_PUNCTUATION_RE = re.compile(r'[^a-z0-9\s]')
+# Deletes the ASCII characters _PUNCTUATION_RE removes, for the common all-ASCII case
+_ASCII_PUNCTUATION_TABLE = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128)) if _PUNCTUATION_RE.match(c)
+))
+
+@lru_cache(maxsize=STRING_CACHE_SIZE)
 def normalize_string(s: str) -> str:
     """Normalize a string for consistent comparison."""
     s = s.lower().strip()
     # Remove content in parentheses or brackets
-    s = re.sub(r'\s*[\(\[\{].*?[\)\]\}]', '', s)
+    s = _BRACKETED_RE.sub('', s)
     # Remove version-specific keywords and their accompanying years if any
-    s = re.sub(r'\b(remastered|live|acoustic|mono|stereo|version|edit|feat\.?|featuring|from|remix)\b(\s+\d{4})?', '', s)
+    s = _KEYWORD_RE.sub('', s)
     # Remove extra punctuation (but keep numbers)
-    s = re.sub(r'[^a-zA-Z0-9\s]', '', s)
+    s = s.translate(_ASCII_PUNCTUATION_TABLE) if s.isascii() else _PUNCTUATION_RE.sub('', s)
     # Remove extra whitespace
-    s = re.sub(r'\s+', ' ', s)
-    return s.strip()
+    return ' '.join(s.split())
+
+@lru_cache(maxsize=STRING_CACHE_SIZE)
+def sort_tokens(s: str) -> str:
+    """Sort the whitespace-separated tokens of a string, as fuzz.token_sort_ratio does before comparing."""
+    return ' '.join(sorted(s.split()))
+
+def normalize_strings(strings: Iterable[str]) -> List[str]:
+    """Normalize a column of strings, running normalize_string once per distinct value."""
+    strings = list(strings)
+    normalized = {s: normalize_string(s) for s in set(strings)}
+    return [normalized[s] for s in strings]
 
 def get_user_input_with_timeout(prompt: str, timeout: int = 10) -> str:
     """Get user input with a timeout."""
@@ -36,5 +74,42 @@ def get_user_input_with_timeout(prompt: str, timeout: int = 10) -> str:
         return ''
     return user_input[0]
 
+@contextmanager
+def terminal_lock() -> Iterator[None]:
+    """Hold an exclusive lock across processes while prompting at the terminal."""
+    if fcntl is None:
+        yield
+        return
+    with open(TERMINAL_LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class RateLimiter:
+    """Token-bucket rate limiter that can be shared between threads."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until a request may be made."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                time.sleep(delay)
+                self.updated = time.monotonic()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
 def get_current_utc_time():
     return datetime.utcnow().replace(tzinfo=timezone.utc)